@@ -1,21 +1,230 @@
 import os
 import re
 import time
-import PyPDF2
-from groq import Groq
-import fitz  #for PDF handling
-from PIL import Image
-import numpy as np
+import json
+import hashlib
+import sqlite3
+import argparse
+import cProfile
+import statistics
+from contextlib import contextmanager
+from functools import lru_cache, partial
+import io
 import random
+import threading
+import itertools
+import zlib
+import multiprocessing
+import csv
+from array import array
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+# PyPDF2, fitz (PyMuPDF), PIL, numpy, groq and httpx are imported in the functions that use them, so importing this
+# file is quick and a run only loads what its stages need
 
 # constant variables
-CHUNK_SIZE = 2700  # What I have found to work with GROQ
+CHUNK_SIZE = 2700  # What I have found to work with GROQ (characters, used by chunk_text)
+CHUNK_TOKENS = {"llama3-8b-8192": 1500}  # target tokens per chunk for each model, leaving room for the prompt and answer
+DEFAULT_CHUNK_TOKENS = 1000  # target for models not listed above
+CHUNK_OVERLAP_TOKENS = 0  # tokens of the end of each chunk repeated at the start of the next one
 LLM_MODEL = "llama3-8b-8192"  # Model used
+LLM_STAGES = ("keywords", "captions")  # the kinds of LLM request, each can go to its own model and endpoint
+LLM_API_KEY_ENV = "LLM_API_KEY"  # environment variable with the key for an OpenAI compatible endpoint, if it needs one
+LLM_TIMEOUT = 120  # seconds to wait for an answer before the request counts as a lost connection
 MEDIA_FOLDER = "anki_media"  # file for the pngs of the figures
+MEDIA_FORMAT = "png"  # figure image format, "png" or "webp" (lossless, smaller, shown by Anki's desktop and mobile apps)
+MEDIA_PNG_COLORS = 256  # png figures are reduced to a palette of this many colours (flat line art barely changes), 0 for full colour
+MEDIA_INDEX = "media_index.json"  # kept in the media folder: the perceptual hash and size of every image saved there
+MEDIA_DHASH_DISTANCE = 4  # bits two 64 bit difference hashes may differ by for the renders to be compared pixel by pixel
+MEDIA_PIXEL_DIFFERENCE = 0.001  # share of pixels two same size renders may differ in (by more than 32 levels) and still be the same image
+FIGURE_DPI = 72  # resolution figures are rendered at (72 is one pixel per pdf point)
 TSV_FILE = "flashcards.tsv"  # Flashcards TSV file name
+DELTA_FILE = "flashcards.new.tsv"  # only the cards added or changed by the last run, for a smaller Anki import
+MAX_WORKERS = 8  # number of LLM requests allowed in flight at once
+REQUESTS_PER_MINUTE = 30  # GROQ free tier request limit for the model
+TOKENS_PER_MINUTE = 30000  # GROQ free tier token limit for the model
+ENDPOINT_REQUESTS_PER_MINUTE = 0  # request limit of a --base-url endpoint, 0 for no limit
+ENDPOINT_TOKENS_PER_MINUTE = 0  # token limit of a --base-url endpoint, 0 for no limit
+MAX_RETRIES = 6  # attempts per request before giving up on a 429 or server error
+CACHE_FILE = ".llm_cache.sqlite"  # on-disk cache of LLM responses so re-runs don't re-send unchanged requests
+CACHE_MAX_BYTES = 200 * 1024 * 1024  # least recently used responses are evicted past this size
+FIGURE_WORKERS = os.cpu_count() or 1  # processes used to render figures, 1 renders them in this process
+JOURNAL_SUFFIX = ".journal.jsonl"  # run journal written next to the output so a failed run can be resumed
+OUTLINE_SUFFIX = ".outline.json"  # cached chapter/section heading index for pdfs without a built-in outline
+HEADING_MIN_SIZE = 15  # font size from which a numbered line like "3.2 Continuous Distributions" counts as a heading
+MODEL_CONTEXT_TOKENS = {"llama3-8b-8192": 8192}  # context window per model, prompt and answer together
+OUTPUT_TOKENS_PER_CHUNK = 700  # answer room kept free for every chunk packed into a batched request
+OUTPUT_TOKENS_PER_CAPTION = 80  # answer room kept free for every caption packed into a batched request
+MAX_BATCH_ITEMS = 8  # most chunks or captions packed into one request
+DEDUP_FRONT_THRESHOLD = 0.85  # shingle similarity at which two card fronts count as the same term
+DEDUP_BACK_THRESHOLD = 0.85  # shingle similarity at which two definitions count as the same card
+MINHASH_PERMUTATIONS = 64  # minhash signature length, split into LSH bands below
+LSH_BANDS = 16  # more bands finds more candidate pairs (4 rows per band with 64 permutations)
+DEDUP_REPORT = "dedup_report.tsv"  # audit log of every card merged by remove_duplicates
+TRACE_FILE = "pipeline_trace.json"  # per-stage timings and LLM call stats, loadable in chrome://tracing or Perfetto
+PROFILE_FOLDER = "profiles"  # where --profile writes cProfile stats for the CPU bound stages
+STREAM_RESPONSES = True  # stream keyword answers so their cards are parsed while the rest of the answer is still coming
+BOOKS_AT_ONCE = 4  # pdfs worked on at the same time when several are given, all sharing the LLM workers and rate limiter
+CARD_STORE_SUFFIX = ".cards.sqlite"  # every card of the last run with its page, chunk and type, saved next to the deck
+DEDUP_REPORT_SUFFIX = ".dedup_report.tsv"  # per book dedup report name when several pdfs are processed together
+CAPTION_WORDS = 100  # words after a figure's label taken as its caption
+FIGURE_CONTEXT_WORDS = 120  # words of the paragraphs referring to a figure sent along with its caption
+FIGURE_CONTEXT_PAGES = 1  # pages either side of a figure searched for paragraphs referring to it
 
-# Initialize
-client = Groq(api_key=os.environ.get("GROQ_API_KEY"))
+STAGES = ("text", "figures")  # pipeline stages that can be picked with --stages
+
+# the Groq client, built by get_client the first time a request is sent (assign your own to use another client)
+client = None
+
+# one keep-alive connection pool per endpoint, with a connection for every LLM worker so requests never wait to
+# connect, speaking HTTP/2 when the h2 package is installed (httpx falls back to HTTP/1.1 without it)
+def http_pool(**options):
+    import httpx
+    import importlib.util
+    return httpx.Client(
+        http2=importlib.util.find_spec("h2") is not None,
+        limits=httpx.Limits(max_connections=MAX_WORKERS, max_keepalive_connections=MAX_WORKERS, keepalive_expiry=60),
+        timeout=httpx.Timeout(LLM_TIMEOUT, connect=10),
+        **options,
+    )
+
+# Initialize (retries are handled by the dispatcher below so they respect the rate limiter)
+def get_client():
+    global client
+    if client is None:
+        from groq import Groq
+        client = Groq(api_key=os.environ.get("GROQ_API_KEY"), max_retries=0, http_client=http_pool())
+    return client
+
+# a failed LLM request worth sending again: a rate limit, a server error or a lost connection
+# kind is the name it's reported under and response, if any, the http response (for its retry-after header)
+class TransientLLMError(Exception):
+    def __init__(self, kind, response=None, rate_limited=False):
+        super().__init__(kind)
+        self.kind = kind
+        self.response = response
+        self.rate_limited = rate_limited
+
+# a chat completions endpoint, the interface every backend has:
+# complete(messages, model) returns (answer, (prompt tokens, completion tokens)) and stream(messages, model)
+# yields (piece of the answer, usage or None) as it arrives; both raise TransientLLMError for what can be retried
+# cache_prefix keeps the cached answers of different endpoints with the same model name apart
+# and rate_limiter is the endpoint's own, so one server's limits (or 429s) never hold back requests to another
+class GroqBackend:
+    cache_prefix = ""  # the responses cached before there were other backends are Groq's
+
+    # the free tier limits, kept in the module's rate_limiter so they can be lifted (see benchmarks/bench_pipeline.py)
+    @property
+    def rate_limiter(self):
+        return rate_limiter
+
+    # the groq client wraps the errors of sending a request, but not those of reading a stream, which come straight
+    # from httpx (e.g. the connection dropping mid-answer), so those are retried as lost connections too
+    @contextmanager
+    def transient_errors(self):
+        import httpx
+        from groq import RateLimitError, InternalServerError, APIConnectionError
+        try:
+            yield
+        except (RateLimitError, InternalServerError, APIConnectionError) as error:
+            raise TransientLLMError(type(error).__name__, getattr(error, "response", None), isinstance(error, RateLimitError)) from error
+        except httpx.TransportError as error:
+            raise TransientLLMError("APIConnectionError") from error
+
+    def complete(self, messages, model):
+        with self.transient_errors():
+            response = get_client().chat.completions.create(messages=messages, model=model)
+        return response.choices[0].message.content, usage_counts(getattr(response, "usage", None))
+
+    # groq reports the usage on the last chunk of the stream, under x_groq
+    def stream(self, messages, model):
+        with self.transient_errors():
+            for chunk in get_client().chat.completions.create(messages=messages, model=model, stream=True):
+                piece = chunk.choices[0].delta.content if chunk.choices else None
+                usage = getattr(getattr(chunk, "x_groq", None), "usage", None) or getattr(chunk, "usage", None)
+                yield piece, usage_counts(usage) if usage else None
+
+# any server with the OpenAI /chat/completions api at base_url (e.g. http://localhost:8080/v1 for llama.cpp's
+# llama-server, http://localhost:8000/v1 for vLLM), talked to directly over the keep-alive pool
+class OpenAICompatibleBackend:
+    def __init__(self, base_url, api_key=None, requests_per_minute=ENDPOINT_REQUESTS_PER_MINUTE, tokens_per_minute=ENDPOINT_TOKENS_PER_MINUTE):
+        base_url = base_url.rstrip("/")
+        self.cache_prefix = base_url + "|"
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.http = http_pool(base_url=base_url + "/", headers={"Authorization": f"Bearer {api_key}"} if api_key else {})
+
+    @contextmanager
+    def transient_errors(self):
+        import httpx
+        try:
+            yield
+        except httpx.TransportError as error:
+            raise TransientLLMError("APIConnectionError") from error
+
+    # 429s and server errors can be retried, anything else (a bad model name, a bad key) raises httpx.HTTPStatusError
+    def check(self, response):
+        if response.status_code == 429:
+            raise TransientLLMError("RateLimitError", response, rate_limited=True)
+        if response.status_code >= 500:
+            raise TransientLLMError("InternalServerError", response)
+        response.raise_for_status()
+
+    def complete(self, messages, model):
+        with self.transient_errors():
+            response = self.http.post("chat/completions", json={"model": model, "messages": messages})
+            self.check(response)
+            body = response.json()
+        return body["choices"][0]["message"]["content"], usage_counts(body.get("usage"))
+
+    # server-sent events, one "data: {chunk}" line each until "data: [DONE]"
+    def stream(self, messages, model):
+        request = {"model": model, "messages": messages, "stream": True, "stream_options": {"include_usage": True}}
+        with self.transient_errors(), self.http.stream("POST", "chat/completions", json=request) as response:
+            if response.status_code >= 400:
+                response.read()
+                self.check(response)
+            for line in response.iter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    continue  # read on to the end of the response so its connection goes back to the pool
+                chunk = json.loads(data)
+                choices = chunk.get("choices") or []
+                piece = (choices[0].get("delta") or {}).get("content") if choices else None
+                usage = (chunk.get("x_groq") or {}).get("usage") or chunk.get("usage")
+                yield piece, usage_counts(usage) if usage else None
+
+# (prompt tokens, completion tokens) from a usage object or dict, 0 for what the server left out
+def usage_counts(usage):
+    if usage is None:
+        return 0, 0
+    if isinstance(usage, dict):
+        return usage.get("prompt_tokens") or 0, usage.get("completion_tokens") or 0
+    return getattr(usage, "prompt_tokens", 0) or 0, getattr(usage, "completion_tokens", 0) or 0
+
+# one backend per endpoint, so every request to it shares its connection pool; None is Groq
+@lru_cache(maxsize=None)
+def llm_backend(base_url=None):
+    if base_url is None:
+        return GroqBackend()
+    return OpenAICompatibleBackend(base_url, os.environ.get(LLM_API_KEY_ENV))
+
+# the (base url, model) each kind of request goes to, change them with configure_llm
+llm_endpoints = {stage: (None, LLM_MODEL) for stage in LLM_STAGES}
+
+# sends one stage's requests (or every stage's, with stage=None) to another model and/or endpoint
+# e.g. configure_llm("captions", model="qwen2.5-3b-instruct", base_url="http://localhost:8080/v1")
+# requests_per_minute and tokens_per_minute limit that endpoint (0 for no limit), Groq keeps its free tier limits
+def configure_llm(stage=None, model=None, base_url=None, requests_per_minute=None, tokens_per_minute=None):
+    for name in LLM_STAGES if stage is None else [stage]:
+        current_url, current_model = llm_endpoints[name]
+        llm_endpoints[name] = (base_url or current_url, model or current_model)
+    if base_url and (requests_per_minute is not None or tokens_per_minute is not None):
+        llm_backend(base_url).rate_limiter = RateLimiter(requests_per_minute or 0, tokens_per_minute or 0)
+
+def stage_model(stage):
+    return llm_endpoints[stage][1]
 
 # Prompt to create standard text content flashcards
 KEYWORD_PROMPT = """
@@ -42,93 +251,1315 @@ Ensure the following:
 Do not include placeholder phrases like "Not provided in the text" or "No definition found." If a good definition cannot be generated, simply skip that term.
 """
 
-# this function extracts text from a pdf file using PyPDF2's PdfReader function
-def extract_text_from_pdf(pdf_path):
+# Added to the keyword prompt when several chunks are sent in one request
+KEYWORD_BATCH_PROMPT = KEYWORD_PROMPT + """
+The text is split into numbered sections, each starting with a line like "### SECTION 1 ###". Work on each section separately and wrap the entries you create for a section between matching markers, like this:
+
+### BEGIN SECTION 1 ###
+### BEGIN ENTRY ###
+Term: [Term]
+Definition: [Definition]
+### END ENTRY ###
+### END SECTION 1 ###
+
+Include the markers for every section, even if a section has no entries.
+"""
+
+# collects timing spans for every stage, per LLM call latency and token counts, retries and cache hits
+# spans are kept as chrome trace events so the export opens in chrome://tracing or Perfetto
+class Instrumentation:
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.events = []
+        self.llm_calls = []
+        self.retries = 0
+        self.profile_folder = None  # set to a folder to write cProfile stats from profile()
+        self.lock = threading.Lock()
+
+    def add_event(self, name, start, duration, args=None):
+        event = {
+            "name": name, "ph": "X", "ts": (start - self.origin) * 1e6, "dur": duration * 1e6,
+            "pid": os.getpid(), "tid": threading.get_ident(), "args": args or {},
+        }
+        with self.lock:
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name, **args):
+        start = time.perf_counter()
+        try:
+            yield args  # the block can add details to the span through this dict
+        finally:
+            self.add_event(name, start, time.perf_counter() - start, args)
+
+    def record_llm_call(self, label, start, latency, prompt_tokens=0, completion_tokens=0, cached=False):
+        call = {
+            "label": label, "latency": latency, "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens, "cached": cached,
+        }
+        with self.lock:
+            self.llm_calls.append(call)
+        self.add_event(f"llm {label}", start, latency, call)
+
+    def record_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    # hands over the events collected so far (used to bring figure worker timings back to the main process)
+    def take_events(self):
+        with self.lock:
+            events, self.events = self.events, []
+        return events
+
+    def merge_events(self, events):
+        with self.lock:
+            self.events.extend(events)
+
+    # runs a CPU bound block under cProfile when a profile folder is set, writing <name>.prof
+    @contextmanager
+    def profile(self, name):
+        if not self.profile_folder:
+            yield
+            return
+        ensure_directory(self.profile_folder)
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(self.profile_folder, f"{name}.prof"))
+
+    def summary(self):
+        stages = {}
+        with self.lock:
+            events = list(self.events)
+            calls = list(self.llm_calls)
+        for event in events:
+            stage = stages.setdefault(event["name"], {"count": 0, "seconds": 0.0})
+            stage["count"] += 1
+            stage["seconds"] += event["dur"] / 1e6
+        sent = [call for call in calls if not call["cached"]]
+        latencies = sorted(call["latency"] for call in sent)
+        llm = {
+            "calls": len(calls),
+            "sent": len(sent),
+            "cached": len(calls) - len(sent),
+            "retries": self.retries,
+            "prompt_tokens": sum(call["prompt_tokens"] for call in sent),
+            "completion_tokens": sum(call["completion_tokens"] for call in sent),
+            "mean_latency": statistics.fmean(latencies) if latencies else 0.0,
+            "p95_latency": latencies[int(0.95 * (len(latencies) - 1))] if latencies else 0.0,
+        }
+        return {"stages": stages, "llm": llm, "cache": response_cache.stats()}
+
+    def export(self, path):
+        with open(path, "w", encoding="utf-8") as trace_file:
+            json.dump({"traceEvents": self.take_events(), "summary": self.summary()}, trace_file)
+
+    # short human readable version of the summary for the end of a run
+    def report(self):
+        summary = self.summary()
+        lines = [f"{name:<24}{stage['count']:>6}x{stage['seconds']:>10.2f}s" for name, stage in sorted(summary["stages"].items())]
+        llm = summary["llm"]
+        lines.append(
+            f"LLM: {llm['sent']} sent, {llm['cached']} from cache, {llm['retries']} retries, "
+            f"{llm['prompt_tokens']} prompt + {llm['completion_tokens']} completion tokens, "
+            f"mean latency {llm['mean_latency']:.2f}s (p95 {llm['p95_latency']:.2f}s)"
+        )
+        return "\n".join(lines)
+
+
+instrumentation = Instrumentation()
+
+# one parsed page: its plain text, the bold left-margin "Figure" spans found on it and its paragraphs that name
+# a figure, as (paragraph number, figure labels, text)
+PageLayout = namedtuple("PageLayout", ["number", "text", "figures", "mentions"])
+# a figure label span on a page, its label ("Figure 2.3"), the caption text that follows the label and the number of
+# the paragraph the caption is in
+FigureSpan = namedtuple("FigureSpan", ["bbox", "label", "caption", "paragraph"])
+FIGURE_LABEL = re.compile(r"(?:Figure|Fig\.)\s*(\d+\.\d+(?:\.\d+)?)")  # the body text often writes "Fig. 2.3"
+
+# "Figure 2.3" for any label FIGURE_LABEL matched, so labels found in different places compare equal
+def figure_label(match):
+    return f"Figure {match.group(1)}"
+
+# this function reads everything the pipeline needs from one page with a single get_text("dict") call
+# plain text is rebuilt from the spans (blocks become paragraphs) and each figure span gets the caption that
+# follows its own label, read from the paragraph the span is in onwards
+def parse_page_layout(page, number, caption_words=CAPTION_WORDS):
+    blocks = []
+    figure_spans = []  # (span, paragraph number, line number in the paragraph)
+    for block in page.get_text("dict")["blocks"]:
+        if "lines" not in block:
+            continue
+        lines = []
+        for line in block["lines"]:
+            for span in line["spans"]:
+                if "Figure" in span["text"] and span["size"] > 10:
+                    is_bold = "Bold" in span["font"] or "Black" in span["font"]
+                    if is_bold and span["bbox"][0] < 50:  # Left margin condition
+                        figure_spans.append((span, len(blocks), len(lines)))
+            lines.append("".join(span["text"] for span in line["spans"]))
+        blocks.append("\n".join(lines))
+    text = "\n\n".join(blocks) + "\n"
+
+    figures = []
+    for span, paragraph, line in figure_spans:
+        following = "\n".join(blocks[paragraph].split("\n")[line:] + blocks[paragraph + 1:])
+        match = FIGURE_LABEL.search(following)
+        if match:
+            label = figure_label(match)
+            caption = " ".join(following[match.end():].split()[:caption_words])
+        else:
+            label, caption = span["text"].strip(), "None"
+        figures.append(FigureSpan(tuple(span["bbox"]), label, caption, paragraph))
+    mentions = []
+    for paragraph, block in enumerate(blocks):
+        labels = {figure_label(match) for match in FIGURE_LABEL.finditer(block)}
+        if labels:
+            mentions.append((paragraph, sorted(labels), block))
+    return PageLayout(number, text, figures, mentions)
+
+# every paragraph of a document that names a figure, filed under the figure's label as pages are parsed, so the
+# text around a figure (on its page or the ones next to it) is a dictionary lookup instead of a rescan of the pages
+# the figure workers build one for their pages and it's merged back into the document's (see merge)
+class FigureIndex:
+    def __init__(self):
+        self.pages = set()  # pages already added
+        self.mentions = {}  # label -> [(page, paragraph number, text)]
+
+    def add_page(self, layout):
+        if layout.number in self.pages:
+            return
+        self.pages.add(layout.number)
+        for paragraph, labels, text in layout.mentions:
+            for label in labels:
+                self.mentions.setdefault(label, []).append((layout.number, paragraph, text))
+
+    def merge(self, other):
+        for number in other.pages - self.pages:
+            self.pages.add(number)
+        for label, mentions in other.mentions.items():
+            known = self.mentions.setdefault(label, [])
+            known.extend(mention for mention in mentions if mention not in known)
+
+    # the paragraphs naming the figure with this label within `pages` pages of page, closest first, cut to max_words
+    # the figure's own caption paragraph is left out
+    def context(self, label, page, paragraph=None, max_words=FIGURE_CONTEXT_WORDS, pages=FIGURE_CONTEXT_PAGES):
+        nearby = sorted(
+            (abs(mention_page - page), mention_page, mention_paragraph, text)
+            for mention_page, mention_paragraph, text in self.mentions.get(label, ())
+            if abs(mention_page - page) <= pages and (mention_page, mention_paragraph) != (page, paragraph)
+        )
+        words = []
+        for *_, text in nearby:
+            words.extend(text.split())
+            if len(words) >= max_words:
+                break
+        return " ".join(words[:max_words])
+
+# this class opens a pdf once with PyMuPDF and is shared by the text and figure stages
+# each page is parsed once; the page text is handed out as it is read, and only the (small) figure spans and
+# the paragraphs naming figures (figure_index) are kept so the figure stage never has to parse the page again
+class PdfDocument:
+    def __init__(self, pdf_path):
+        import fitz  #for PDF handling
+        self.path = pdf_path
+        self.document = fitz.open(pdf_path)
+        self.figure_spans = {}
+        self.figure_index = FigureIndex()
+
+    def __len__(self):
+        return len(self.document)
+
+    def page(self, number):
+        return self.document[number]
+
+    def layout(self, number):
+        with instrumentation.span("parse page", page=number + 1):
+            layout = parse_page_layout(self.document[number], number)
+        self.figure_spans[number] = layout.figures
+        self.figure_index.add_page(layout)
+        return layout
+
+    # yields the layout of every page (or of just the given page numbers) in order
+    def iter_layouts(self, page_numbers=None):
+        for number in range(len(self.document)) if page_numbers is None else page_numbers:
+            yield self.layout(number)
+
+    # figure spans for a page, from the earlier parse when there was one
+    def figures_on_page(self, number):
+        if number not in self.figure_spans:
+            self.layout(number)
+        return self.figure_spans[number]
+
+    def close(self):
+        self.document.close()
+
+# this function yields the text of each page of the shared document, for the chunker
+def iter_document_pages(document, page_numbers=None):
+    for layout in document.iter_layouts(page_numbers):
+        yield layout.text
+
+# turns "10-40,55" (pages as printed by a pdf viewer, starting at 1) into sorted 0-based page numbers
+# "10-" runs to the last page; a range starting past the last page, or a selection of no pages, is a ValueError
+def parse_page_ranges(text, page_count):
+    page_numbers = set()
+    for part in text.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, dash, last = part.partition("-")
+        first = int(first)
+        last = int(last) if last.strip() else page_count if dash else first
+        if first < 1 or last < first:
+            raise ValueError(f"Bad page range '{part}'")
+        if first > page_count:
+            raise ValueError(f"Page range '{part}' starts past the last page ({page_count})")
+        page_numbers.update(range(first - 1, min(last, page_count)))
+    if not page_numbers:
+        raise ValueError(f"No pages selected by '{text}'")
+    return sorted(page_numbers)
+
+HEADING_NUMBER = re.compile(r"^(?:Chapter\s+)?(\d+(?:\.\d+)*)\b")
+
+# finds chapter and section headings by their font size when the pdf has no outline
+# a chapter opener is a "Chapter" span next to a very large number, a section is a large "3.2 Title" line
+# returns [level, title, page] entries like fitz's get_toc()
+def scan_headings(fitz_document):
+    outline = []
+    for number, page in enumerate(fitz_document):
+        spans = [
+            span for block in page.get_text("dict")["blocks"] for line in block.get("lines", []) for span in line["spans"]
+            if span["size"] >= HEADING_MIN_SIZE and span["text"].strip()
+        ]
+        texts = [span["text"].strip() for span in spans]
+        if "Chapter" in texts:
+            digits = [span for span in spans if span["text"].strip().isdigit()]
+            if digits:
+                chapter = max(digits, key=lambda span: span["size"])["text"].strip()
+                outline.append([1, f"Chapter {chapter}", number + 1])
+        for text in texts:
+            if re.match(r"^Chapter\s+\d+$", text):
+                outline.append([1, text, number + 1])
+            elif re.match(r"^\d+\.\d+\s+\S", text):
+                outline.append([2, text, number + 1])
+    return outline
+
+# chapter/section index of the pdf: its built-in outline if it has one, otherwise the scanned headings,
+# cached next to the output so the scan only happens once per pdf
+def load_outline(document):
+    outline = document.document.get_toc(simple=True)
+    if outline:
+        return outline
+    cache_path = os.path.splitext(os.path.basename(document.path))[0] + OUTLINE_SUFFIX
+    stat = os.stat(document.path)
+    fingerprint = [stat.st_size, stat.st_mtime]
+    if os.path.exists(cache_path):
+        with open(cache_path, encoding="utf-8") as cache_file:
+            cached = json.load(cache_file)
+        if cached["pdf"] == fingerprint:
+            return cached["outline"]
+    print("Building heading index...")
+    outline = scan_headings(document.document)
+    with open(cache_path, "w", encoding="utf-8") as cache_file:
+        json.dump({"pdf": fingerprint, "outline": outline}, cache_file)
+    return outline
+
+# page numbers (0-based) covered by chapters or sections like "3,4" or "3.2"
+# a heading covers its page up to the page before the next heading at the same or a higher level
+def chapter_pages(outline, chapters, page_count):
+    wanted = {chapter.strip() for chapter in chapters.split(",") if chapter.strip()}
+    page_numbers = set()
+    found = set()
+    for index, (level, title, start) in enumerate(outline):
+        match = HEADING_NUMBER.match(title.strip())
+        if not match or match.group(1) not in wanted:
+            continue
+        found.add(match.group(1))
+        end = page_count
+        for next_level, _, next_start in outline[index + 1:]:
+            if next_level <= level:
+                end = next_start - 1
+                break
+        page_numbers.update(range(start - 1, max(start, end)))
+    missing = wanted - found
+    if missing:
+        raise ValueError(f"Chapter(s) {', '.join(sorted(missing))} not found in the pdf outline")
+    return page_numbers
+
+# resolves the --pages and --chapter options into sorted 0-based page numbers, or None for the whole pdf
+def select_pages(document, pages=None, chapters=None):
+    if not pages and not chapters:
+        return None
+    page_numbers = set()
+    if pages:
+        page_numbers.update(parse_page_ranges(pages, len(document)))
+    if chapters:
+        page_numbers.update(chapter_pages(load_outline(document), chapters, len(document)))
+    return sorted(page_numbers)
+
+# this function yields the text of each page of a pdf one at a time using PyPDF2's PdfReader function
+# so later stages can start working before the whole book has been read
+def iter_pdf_pages(pdf_path):
+    import PyPDF2
     with open(pdf_path, 'rb') as file:
         reader = PyPDF2.PdfReader(file)
-        text = ""
         for page in reader.pages:
-            text += page.extract_text() + "\n"
-    return text
+            yield page.extract_text() + "\n"
+
+# this function extracts the full text from a pdf file
+def extract_text_from_pdf(pdf_path):
+    return "".join(iter_pdf_pages(pdf_path))
+
+NON_WHITESPACE = re.compile(r"\S")
+
+# this function turns a stream of text pieces (pages) into chunks using the token size limits set earlier
+# it walks an offset through a buffer instead of re-slicing the remaining text, and the buffer never holds
+# more than one chunk plus the newest page
+def iter_chunks(pieces, chunk_size=CHUNK_SIZE):
+    buffer = ""
+    split_before = False  # after the first split, leading whitespace is dropped from the remaining text
+    pieces = iter(pieces)
+    while True:
+        piece = next(pieces, None)
+        if piece is None:
+            buffer = buffer.rstrip()
+        else:
+            buffer += piece
+
+        start = 0
+        if split_before:
+            next_text = NON_WHITESPACE.search(buffer)
+            start = next_text.start() if next_text else len(buffer)
+        text_end = len(buffer.rstrip())  # trailing whitespace may turn out to be the end of the book
+        while text_end - start > chunk_size:
+            end = start + chunk_size
+            split_point = buffer.rfind("\n\n", start, end)  # Split at the last paragraph break
+            if split_point == -1:
+                split_point = end  # If no paragraph break, split arbitrarily
+            chunk = buffer[start:split_point].strip()
+            if chunk:
+                yield chunk
+            split_before = True
+            next_text = NON_WHITESPACE.search(buffer, split_point)
+            start = next_text.start() if next_text else len(buffer)
+        buffer = buffer[start:]
+
+        if piece is None:
+            break
+    if buffer.strip():
+        yield buffer.strip()
 
 # this function splits chunks using the token size limits set earlier
 def chunk_text(text, chunk_size=CHUNK_SIZE):
-    chunks = []
-    while len(text) > chunk_size:
-        split_point = text[:chunk_size].rfind("\n\n")  # Split at the last paragraph break
-        if split_point == -1:
-            split_point = chunk_size  # If no paragraph break, split arbitrarily
-        chunks.append(text[:split_point].strip())
-        text = text[split_point:].strip()
-    if text:
-        chunks.append(text)
-    return chunks
-
-# this function generates flashcards for the text chunks using a call to the LLM
-# with the keyword prompt we set earlier
-def generate_flashcards_with_llm(chunks):
-    flashcards = []
-
-    for i, chunk in enumerate(chunks, start=1):
-        print(f"Processing chunk {i}/{len(chunks)}...")
-
-        # Send chunk to LLM
-        response = client.chat.completions.create(
-            messages=[
-                {'role': 'system', 'content': KEYWORD_PROMPT},
-                {'role': 'user', 'content': chunk}
-            ],
-            model=LLM_MODEL,
-        )
+    return list(iter_chunks([text], chunk_size))
 
-        output = response.choices[0].message.content
-        flashcards.append(output)
+WORD_PATTERN = re.compile(r"[A-Za-z]+")
+NUMBER_PATTERN = re.compile(r"\d{1,3}")
+SYMBOL_PATTERN = re.compile(r"[^\sA-Za-z\d]")
 
-        time.sleep(10)
+# token count estimate calibrated for llama 3 style BPE tokenizers without having to download one:
+# a common word is one token and long words split about every 8 letters, numbers split into groups of
+# up to three digits, and punctuation and math symbols are a token each
+def estimate_tokens(text):
+    words = WORD_PATTERN.findall(text)
+    return (
+        len(words) + sum(len(word) for word in words if len(word) > 8) // 8
+        + len(NUMBER_PATTERN.findall(text))
+        + len(SYMBOL_PATTERN.findall(text))
+        + 1
+    )
 
-    return flashcards
+# target chunk size in tokens for a model
+def chunk_token_budget(model=None):
+    return CHUNK_TOKENS.get(model or stage_model("keywords"), DEFAULT_CHUNK_TOKENS)
+
+# this function yields the paragraphs of a stream of text pieces, a paragraph can run across pieces (pages)
+def iter_paragraphs(pieces):
+    buffer = ""
+    for piece in pieces:
+        buffer += piece
+        paragraphs = buffer.split("\n\n")
+        buffer = paragraphs.pop()  # may continue in the next piece
+        for paragraph in paragraphs:
+            if paragraph.strip():
+                yield paragraph.strip()
+    if buffer.strip():
+        yield buffer.strip()
+
+# this function breaks a paragraph that is too big for one chunk into pieces of at most max_tokens,
+# at line breaks where it can and between words where it has to
+def split_paragraph(paragraph, max_tokens):
+    tokens = estimate_tokens(paragraph)
+    if tokens <= max_tokens:
+        yield paragraph, tokens
+        return
+    for separator, units in (("\n", paragraph.split("\n")), (" ", paragraph.split())):
+        if len(units) > 1:
+            break
+    part = []
+    part_tokens = 0
+    for unit in units:
+        unit_tokens = estimate_tokens(unit)
+        if unit_tokens > max_tokens and separator == "\n":
+            if part:
+                yield separator.join(part), part_tokens
+                part, part_tokens = [], 0
+            yield from split_paragraph(unit, max_tokens)
+            continue
+        if part and part_tokens + unit_tokens > max_tokens:
+            yield separator.join(part), part_tokens
+            part, part_tokens = [], 0
+        part.append(unit)
+        part_tokens += unit_tokens
+    if part:
+        yield separator.join(part), part_tokens
+
+# this function turns a stream of text pieces (pages) into paragraph aligned chunks of about target_tokens each
+# the last overlap_tokens worth of paragraphs of each chunk are repeated at the start of the next one
+# stats, if given, collects the token count of every chunk
+def iter_token_chunks(pieces, target_tokens=None, overlap_tokens=CHUNK_OVERLAP_TOKENS, stats=None):
+    target_tokens = target_tokens or chunk_token_budget()
+    overlap_tokens = min(overlap_tokens, target_tokens // 2)
+    current = []  # (paragraph, tokens)
+    used = 0
+    carried = 0  # paragraphs at the start of current that were already in the previous chunk
+
+    def finish():
+        if stats is not None:
+            stats.append(used)
+        return "\n\n".join(paragraph for paragraph, _ in current)
+
+    for paragraph in iter_paragraphs(pieces):
+        for part, tokens in split_paragraph(paragraph, target_tokens):
+            if current and used + tokens > target_tokens:
+                if len(current) > carried:
+                    yield finish()
+                    kept = []
+                    kept_tokens = 0
+                    for previous in reversed(current):
+                        if kept_tokens + previous[1] > overlap_tokens:
+                            break
+                        kept.insert(0, previous)
+                        kept_tokens += previous[1]
+                    if not kept and overlap_tokens:
+                        # the last paragraph is bigger than the overlap, so carry its last lines instead
+                        lines = []
+                        for line in reversed(current[-1][0].split("\n")):
+                            line_tokens = estimate_tokens(line)
+                            if kept_tokens + line_tokens > overlap_tokens:
+                                break
+                            lines.insert(0, line)
+                            kept_tokens += line_tokens
+                        if lines:
+                            kept = [("\n".join(lines), kept_tokens)]
+                    current = kept
+                else:
+                    current = []  # the overlap alone leaves no room for this part
+                used = sum(tokens for _, tokens in current)
+                carried = len(current)
+            current.append((part, tokens))
+            used += tokens
+    if len(current) > carried:
+        yield finish()
+
+# how full the chunks were, as a line for the end of the text stage
+def chunk_utilization_report(chunk_tokens, target_tokens, model=None):
+    if not chunk_tokens:
+        return "No chunks"
+    average = sum(chunk_tokens) / len(chunk_tokens)
+    context = MODEL_CONTEXT_TOKENS.get(model or stage_model("keywords"), 8192)
+    prompt = estimate_tokens(KEYWORD_PROMPT)
+    return (
+        f"{len(chunk_tokens)} chunks averaging {average:.0f} tokens: {average / target_tokens:.0%} of the "
+        f"{target_tokens} token chunk target, {(average + prompt) / context:.0%} of the {context} token context"
+    )
+
+# token bucket that keeps us under both the requests per minute and tokens per minute limits
+# every request takes one request token and its estimated number of tokens, and waits until both buckets can cover it
+# a limit of 0 is no limit, that bucket is never waited on
+class RateLimiter:
+    def __init__(self, requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE):
+        self.request_capacity = requests_per_minute
+        self.token_capacity = tokens_per_minute
+        self.request_tokens = float(requests_per_minute)
+        self.token_tokens = float(tokens_per_minute)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        self.updated = now
+        self.request_tokens = min(self.request_capacity, self.request_tokens + elapsed * self.request_capacity / 60)
+        self.token_tokens = min(self.token_capacity, self.token_tokens + elapsed * self.token_capacity / 60)
+
+    def acquire(self, tokens):
+        requests = 1 if self.request_capacity else 0
+        tokens = min(tokens, self.token_capacity)  # a single huge request still has to go through eventually
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self.blocked_until - now
+                if wait <= 0:
+                    if self.request_tokens >= requests and self.token_tokens >= tokens:
+                        self.request_tokens -= requests
+                        self.token_tokens -= tokens
+                        return
+                    request_wait = (requests - self.request_tokens) * 60 / self.request_capacity if requests else 0
+                    token_wait = (tokens - self.token_tokens) * 60 / self.token_capacity if tokens else 0
+                    wait = max(request_wait, token_wait)
+            with instrumentation.span("rate limit wait"):
+                time.sleep(wait)
+
+    # called when the API answers with a 429 so every worker sending to it pauses, not just the one that got rejected
+    def block_for(self, seconds):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+rate_limiter = RateLimiter()
+
+# persistent LLM response cache stored in SQLite, keyed by a hash of the model, system prompt and user content
+# entries carry a last used timestamp so the cache can evict least recently used responses once it grows past max_bytes
+class ResponseCache:
+    def __init__(self, path=CACHE_FILE, max_bytes=CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.connection = None
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    # opened on first use so just importing this file doesn't create the cache
+    def _connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+            self.connection.commit()
+            self.total_bytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        return self.connection
+
+    @staticmethod
+    def key(model, system_prompt, user_content):
+        payload = json.dumps([model, system_prompt, user_content], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            connection = self._connect()
+            row = connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            connection.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, response):
+        size = len(response.encode("utf-8"))
+        with self.lock:
+            connection = self._connect()
+            old = connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            connection.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, response, size, time.time()),
+            )
+            self.total_bytes += size - (old[0] if old else 0)
+            self._evict(connection)
+            connection.commit()
+
+    # drops the least recently used responses until the cache fits in max_bytes again
+    def _evict(self, connection):
+        while self.total_bytes > self.max_bytes:
+            rows = connection.execute("SELECT key, size FROM responses ORDER BY last_used LIMIT 64").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.total_bytes -= size
+                if self.total_bytes <= self.max_bytes:
+                    break
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "bytes": self.total_bytes}
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+
+response_cache = ResponseCache()
+
+# append-only log of finished work so a crashed run can pick up where it stopped
+# every line is one json record ({"stage": ..., "id": ..., "result": ...}) flushed and fsync'd as soon as it is written
+class RunJournal:
+    def __init__(self, path, run_info, resume=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.records = self._load(run_info) if resume and os.path.exists(path) else {}
+
+        # rewrite the journal with the records we kept, which also drops a line cut off by a crash
+        self.file = open(path, "w", encoding="utf-8")
+        self._write({"stage": "run", "id": None, "result": run_info})
+        for stage, results in self.records.items():
+            for record_id, result in results.items():
+                self._write({"stage": stage, "id": record_id, "result": result})
+
+    def _load(self, run_info):
+        records = {}
+        header = None
+        with open(self.path, encoding="utf-8") as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # partial line from the crash
+                if entry["stage"] == "run":
+                    header = entry["result"]
+                else:
+                    records.setdefault(entry["stage"], {})[entry["id"]] = entry["result"]
+        if header != run_info:
+            print(f"Journal {self.path} was written with different settings, starting over")
+            return {}
+        return records
+
+    def _write(self, entry):
+        self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def record(self, stage, record_id, result):
+        with self.lock:
+            self.records.setdefault(stage, {})[record_id] = result
+            self._write({"stage": stage, "id": record_id, "result": result})
+
+    def completed(self, stage):
+        with self.lock:
+            return dict(self.records.get(stage, {}))
+
+    def close(self):
+        self.file.close()
+
+# journal file for a pdf, named after it in the working directory
+def journal_path_for(pdf_path):
+    return os.path.splitext(os.path.basename(pdf_path))[0] + JOURNAL_SUFFIX
+
+# reads the retry-after header from a rate limit error, if the API sent one
+def retry_after_seconds(error):
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    value = response.headers.get("retry-after")
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+# sends one chat completion through its endpoint's rate limiter, retrying 429s and server errors with jittered exponential backoff
+# responses already in the cache are returned without touching the network
+# the request goes to the model and endpoint configured for its stage (see configure_llm), model overrides the model
+# with a parser (see EntryParser) the answer is streamed and fed to it as it arrives; the parser is reset before a retry
+# on_card(card), with a parser, gets each card as soon as the parser finishes it, while the rest is still streaming;
+# a retried request only passes on the cards after those the broken off attempt already passed on
+def call_llm(system_prompt, user_content, model=None, label="request", parser=None, stage="keywords", on_card=None):
+    start = time.perf_counter()
+    base_url, stage_default = llm_endpoints[stage]
+    model = model or stage_default
+    backend = llm_backend(base_url)
+    delivered = 0  # cards of this request passed to on_card so far
+
+    def pass_on_cards():
+        nonlocal delivered
+        for card in parser.cards[delivered:]:
+            on_card(card)
+        delivered = max(delivered, len(parser.cards))
+
+    on_cards = pass_on_cards if parser is not None and on_card is not None else None
+    cache_key = response_cache.key(backend.cache_prefix + model, system_prompt, user_content)
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        instrumentation.record_llm_call(label, start, time.perf_counter() - start, cached=True)
+        if parser is not None:
+            parser.feed(cached)
+            parser.close()
+            if on_cards is not None:
+                on_cards()
+        return cached
+
+    messages = [
+        {'role': 'system', 'content': system_prompt},
+        {'role': 'user', 'content': user_content}
+    ]
+    tokens = estimate_tokens(system_prompt) + estimate_tokens(user_content)
+    for attempt in range(MAX_RETRIES):
+        backend.rate_limiter.acquire(tokens)
+        try:
+            request_start = time.perf_counter()
+            if parser is None:
+                output, (prompt_tokens, completion_tokens) = backend.complete(messages, model)
+            else:
+                parser.reset()
+                output, (prompt_tokens, completion_tokens) = read_stream(backend.stream(messages, model), parser, on_cards)
+            instrumentation.record_llm_call(
+                label, request_start, time.perf_counter() - request_start,
+                prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+            )
+            response_cache.put(cache_key, output)
+            return output
+        except TransientLLMError as error:
+            if attempt == MAX_RETRIES - 1:
+                raise
+            instrumentation.record_retry()
+            backoff = min(60, 2 ** attempt) * random.uniform(0.5, 1.5)
+            retry_after = retry_after_seconds(error)
+            if retry_after is not None:
+                backoff = retry_after + random.uniform(0, 1)
+            if error.rate_limited:
+                backend.rate_limiter.block_for(backoff)
+            print(f"LLM request failed ({error.kind}), retrying in {backoff:.1f}s...")
+            with instrumentation.span("retry backoff", error=error.kind):
+                time.sleep(backoff)
+
+# reads a streamed answer (see the backends' stream), feeding every piece to the parser as it arrives
+# on_cards() is called whenever a piece (or the end of the answer) finishes more cards
+# returns (whole answer, (prompt tokens, completion tokens)), the usage comes with the last piece
+def read_stream(stream, parser, on_cards=None):
+    pieces = []
+    usage = (0, 0)
+    for piece, piece_usage in stream:
+        if piece:
+            pieces.append(piece)
+            if parser.feed(piece) and on_cards is not None:
+                on_cards()
+        usage = piece_usage or usage
+    parser.close()
+    if on_cards is not None:
+        on_cards()
+    return "".join(pieces), usage
+
+# the one pool of MAX_WORKERS threads every LLM request goes through, so when several books are worked on at once
+# their chunks and captions share one queue (and the rate limiter) instead of each book getting its own workers
+@lru_cache(maxsize=None)
+def llm_executor():
+    return ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="llm")
+
+# runs the same system prompt over many user messages at once and returns the outputs in input order
+# user_contents can be a generator: requests are submitted as items arrive, with only a bounded number waiting
+# on_result(index, output) is called from the worker as soon as each request finishes
+# make_parser(index), if given, returns the parser each answer is streamed into (see call_llm)
+# and on_card(index, card) is then called from the worker with each card as it is parsed, before the answer is done
+# stage picks the model and endpoint the requests go to (see configure_llm)
+def dispatch_llm_calls(system_prompt, user_contents, label="request", on_result=None, make_parser=None, stage="keywords",
+                       on_card=None):
+    total = len(user_contents) if hasattr(user_contents, "__len__") else None
+    done = 0
+    done_lock = threading.Lock()
+
+    def run(index, content):
+        nonlocal done
+        parser = make_parser(index) if make_parser is not None else None
+        card_callback = partial(on_card, index) if on_card is not None else None
+        output = call_llm(system_prompt, content, label=label, parser=parser, stage=stage, on_card=card_callback)
+        if on_result is not None:
+            on_result(index, output)
+        with done_lock:
+            done += 1
+            print(f"Finished {label} {done}/{total}..." if total else f"Finished {label} {done}...")
+        return output
+
+    outputs = []
+    in_flight = deque()
+    executor = llm_executor()
+    for index, content in enumerate(user_contents):
+        if len(in_flight) >= 2 * MAX_WORKERS:
+            outputs.append(in_flight.popleft().result())
+        in_flight.append(executor.submit(run, index, content))
+    outputs.extend(future.result() for future in in_flight)
+    return outputs
+
+# groups (id, text) items into batches that fit the model's context window, answers included
+# keeps the items in order and works on a generator, so batches go out while later items are still coming
+def pack_batches(items, system_prompt, output_tokens_per_item, model=LLM_MODEL, max_items=MAX_BATCH_ITEMS):
+    budget = MODEL_CONTEXT_TOKENS.get(model, 8192) - estimate_tokens(system_prompt)
+    batch = []
+    used = 0
+    for item in items:
+        cost = estimate_tokens(item[1]) + output_tokens_per_item + 10  # 10 for the section marker
+        if batch and (used + cost > budget or len(batch) >= max_items):
+            yield batch
+            batch = []
+            used = 0
+        batch.append(item)
+        used += cost
+    if batch:
+        yield batch
+
+# user message for a batch: every item under its own numbered marker
+def format_batch(batch, marker):
+    return "\n\n".join(f"### {marker} {number} ###\n{text}" for number, (_, text) in enumerate(batch, start=1))
+
+# splits a batched keyword answer back into {section number: that section's entries}
+def split_batched_output(output):
+    sections = re.findall(r"### BEGIN SECTION (\d+) ###(.*?)### END SECTION \1 ###", output, re.DOTALL)
+    return {int(number): text for number, text in sections}
+
+# this function generates flashcards for the text chunks using concurrent calls to the LLM
+# with the keyword prompt we set earlier, skipping chunks the run journal already has
+# chunks can be a generator, so chunks are sent while later pages are still being read
+# with batch=True several chunks share one request; a chunk the model left out of its answer is sent again on its own
+# returns the (front, back) cards of each chunk; without batching they are parsed while the answer streams in
+# on_card(chunk number, card) gets every card of the chunks sent, called from the workers: while the answer is still
+# streaming in if it is streamed, otherwise once the answer is parsed
+def generate_flashcards_with_llm(chunks, journal=None, batch=False, stream=STREAM_RESPONSES, on_card=None):
+    finished = journal.completed("chunk") if journal else {}
+    if finished:
+        print(f"Resuming: {len(finished)} chunks already done")
+    parsers = {}  # request index -> the EntryParser its answer was streamed into
+    results = {}
+    rejected = {}  # chunk number -> entries its answer had that didn't make a card, added up once all are back
+    for chunk_number, output in finished.items():
+        parser = EntryParser()
+        parser.feed(output)
+        results[chunk_number] = parser.close()
+        rejected[chunk_number] = parser.rejected
+    sent = []  # the (chunk number, chunk) groups in dispatch order
+    chunk_count = 0
+
+    def pending_chunks():
+        nonlocal chunk_count
+        for i, chunk in enumerate(chunks):
+            chunk_count = i + 1
+            if i not in finished:
+                yield (i, chunk)
+
+    def requests():
+        groups = pack_batches(pending_chunks(), KEYWORD_BATCH_PROMPT, OUTPUT_TOKENS_PER_CHUNK, stage_model("keywords")) if batch else ([item] for item in pending_chunks())
+        for group in groups:
+            sent.append(group)
+            yield format_batch(group, "SECTION") if batch else group[0][1]
+
+    def make_parser(index):
+        parsers[index] = EntryParser()
+        return parsers[index]
+
+    def streamed_card(index, card):
+        on_card(sent[index][0][0], card)
+
+    def record(index, output):
+        group = sent[index]
+        outputs = split_batched_output(output) if batch else {1: output}
+        for number, (chunk_number, chunk) in enumerate(group, start=1):
+            chunk_output = outputs.get(number)
+            parser = parsers.pop(index, None) if not batch else None
+            if chunk_output is None:
+                parser = EntryParser() if stream else None
+                chunk_output = call_llm(
+                    KEYWORD_PROMPT, chunk, label="chunk fallback", parser=parser,
+                    on_card=partial(on_card, chunk_number) if on_card is not None else None,
+                )
+            if parser is None:
+                parser = EntryParser()
+                parser.feed(chunk_output)
+                parser.close()
+                if on_card is not None:
+                    for card in parser.cards:
+                        on_card(chunk_number, card)
+            results[chunk_number] = parser.cards
+            rejected[chunk_number] = parser.rejected
+            if journal:
+                journal.record("chunk", chunk_number, chunk_output)
+
+    print("Processing chunks...")
+    system_prompt = KEYWORD_BATCH_PROMPT if batch else KEYWORD_PROMPT
+    dispatch_llm_calls(
+        system_prompt, requests(), label="batch" if batch else "chunk", on_result=record,
+        make_parser=make_parser if stream and not batch else None,
+        on_card=streamed_card if stream and not batch and on_card is not None else None,
+    )
+    if batch:
+        print(f"Sent {chunk_count - len(finished)} chunks in {len(sent)} requests")
+    skipped = sum(rejected.values())
+    if skipped:
+        print(f"Skipped {skipped} malformed or placeholder entries")
+    return [results[i] for i in range(chunk_count)]
+
+ENTRY_BEGIN = re.compile(r"#+\s*BEGIN ENTRY\s*#+")
+ENTRY_END = re.compile(r"#+\s*END ENTRY\s*#+")
+ENTRY_FIELD = re.compile(r"\**\s*(term|definition)\s*\**\s*:\s*\**\s*(.*)", re.IGNORECASE)
+# answers the prompt asks the model not to give, a card with one of these as its front or back is dropped
+PLACEHOLDER = re.compile(
+    r"\W*(n/?a|none|unknown|unknown term|\[?term\]?|\[?definition\]?|no definition( available| found)?|"
+    r"not (provided|found|available|given)( in the text)?)\W*",
+    re.IGNORECASE,
+)
+
+# turns the ### BEGIN ENTRY ### / ### END ENTRY ### answer format into (front, back) cards in one pass
+# text can be fed in pieces of any size (e.g. as it streams in), each call returns the cards finished by that piece
+# fields can run over several lines; an entry missing its term or definition, with a placeholder in either, with
+# stray text before its first field, or cut off before its end marker is counted in rejected instead of becoming a card
+class EntryParser:
+    def __init__(self):
+        self.cards = []
+        self.rejected = 0
+        self.reset()
+
+    # forgets everything fed so far (call_llm does this before a retried request streams in again)
+    def reset(self):
+        self.cards.clear()
+        self.rejected = 0
+        self.pending = ""  # the unfinished last line
+        self.fields = None  # {field name: lines} of the entry being read, None outside an entry
+        self.field = None
+        self.malformed = False
+
+    def feed(self, text):
+        lines = (self.pending + text).split("\n")
+        self.pending = lines.pop()
+        count = len(self.cards)
+        for line in lines:
+            self._line(line)
+        return self.cards[count:]
+
+    # the answer is complete: reads the last line (which has no newline after it) and drops an unfinished entry
+    def close(self):
+        if self.pending:
+            self._line(self.pending)
+            self.pending = ""
+        if self.fields is not None:
+            self.rejected += 1
+            self.fields = None
+        return self.cards
+
+    def _line(self, line):
+        stripped = line.strip()
+        if ENTRY_BEGIN.fullmatch(stripped):
+            if self.fields is not None:
+                self.rejected += 1  # the last entry never ended
+            self.fields, self.field, self.malformed = {}, None, False
+        elif self.fields is None:
+            return  # text between entries
+        elif ENTRY_END.fullmatch(stripped):
+            self._finish_entry()
+        elif (match := ENTRY_FIELD.fullmatch(stripped)) is not None:
+            self.field = match.group(1).lower()
+            if self.field in self.fields:
+                self.malformed = True  # two terms or two definitions in one entry
+            self.fields[self.field] = [match.group(2)]
+        elif self.field is not None:
+            self.fields[self.field].append(stripped)
+        elif stripped:
+            self.malformed = True
+
+    def _finish_entry(self):
+        fields, self.fields, self.field = self.fields, None, None
+        term = "\n".join(fields.get("term", [])).strip().strip("*").strip()
+        definition = "\n".join(fields.get("definition", [])).strip().strip("*").strip()
+        if self.malformed or not term or not definition or PLACEHOLDER.fullmatch(term) or PLACEHOLDER.fullmatch(definition):
+            self.rejected += 1
+            return
+        self.cards.append((term, definition))
 
 # format the LLM output into front and back of flashcards using the ### BEGIN ENTRY ### and ### END ENTRY ### that was insisted on
 def parse_llm_output(output):
-    flashcards = []
-    entries = re.findall(r"### BEGIN ENTRY ###(.*?)### END ENTRY ###", output, re.DOTALL)
+    parser = EntryParser()
+    parser.feed(output)
+    return parser.close()
 
-    for entry in entries:
-        term_match = re.search(r"Term: (.*?)\n", entry)
-        definition_match = re.search(r"Definition: (.*?)\n", entry)
+TEXT_CARD = 0
+FIGURE_CARD = 1
 
-        term = term_match.group(1).strip() if term_match else "Unknown Term"
-        definition = definition_match.group(1).strip() if definition_match else "No definition available."
+# the cards of a run, kept as columns: every front and back string is stored once in a shared table and the
+# cards hold its index, next to the card type, source page (0-based, -1 if unknown), chunk number (-1 for figure
+# cards) and the card id as a 64 bit number
+# it reads like a list of (front, back) tuples; take() makes a view of some of the cards in any order that shares
+# the strings and columns, so dedup, filtering and shuffling only move row numbers around
+class CardStore:
+    COLUMNS = (("fronts", "I"), ("backs", "I"), ("types", "B"), ("pages", "i"), ("chunks", "i"), ("hashes", "Q"))
 
-        flashcards.append((term, definition))
+    def __init__(self):
+        self.strings = []
+        self.string_ids = {}
+        for name, typecode in self.COLUMNS:
+            setattr(self, name, array(typecode))
+        self.rows = array("I")  # the cards in this store or view, as row numbers into the columns
 
-    return flashcards
+    def intern(self, text):
+        string_id = self.string_ids.get(text)
+        if string_id is None:
+            string_id = self.string_ids[text] = len(self.strings)
+            self.strings.append(text)
+        return string_id
+
+    # source is what a figure card was made from (its label and caption), part of its id (see card_id)
+    def add(self, front, back, card_type=TEXT_CARD, page=-1, chunk=-1, source="", identifier=None):
+        self.rows.append(len(self.fronts))
+        self.fronts.append(self.intern(front))
+        self.backs.append(self.intern(back))
+        self.types.append(card_type)
+        self.pages.append(page)
+        self.chunks.append(chunk)
+        self.hashes.append(identifier if identifier is not None else int(card_id(front, back, source), 16))
+
+    # adds every card of another store (strings are interned again into this store's table), ids included
+    def extend(self, other):
+        for row in other.rows:
+            self.add(
+                other.strings[other.fronts[row]], other.strings[other.backs[row]],
+                other.types[row], other.pages[row], other.chunks[row], identifier=other.hashes[row],
+            )
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        row = self.rows[index]
+        return self.strings[self.fronts[row]], self.strings[self.backs[row]]
+
+    def __iter__(self):
+        strings, fronts, backs = self.strings, self.fronts, self.backs
+        for row in self.rows:
+            yield strings[fronts[row]], strings[backs[row]]
+
+    def card_id(self, index):
+        return format(self.hashes[self.rows[index]], "016x")
+
+    # a view of the cards at these positions, in this order
+    def take(self, indexes):
+        view = CardStore.__new__(CardStore)
+        view.__dict__.update(self.__dict__)
+        view.rows = array("I", (self.rows[index] for index in indexes))
+        return view
+
+    # a view of the cards of one type and/or on some pages
+    def select(self, card_type=None, pages=None):
+        pages = set(pages) if pages is not None else None
+        return self.take(
+            index for index, row in enumerate(self.rows)
+            if (card_type is None or self.types[row] == card_type) and (pages is None or self.pages[row] in pages)
+        )
+
+    def shuffled(self):
+        indexes = list(range(len(self.rows)))
+        random.shuffle(indexes)
+        return self.take(indexes)
+
+    # writes the cards of this store (or view) to a SQLite file: the string table, and every column as one blob
+    def save(self, path):
+        compact = CardStore()
+        compact.extend(self)  # drops the strings and rows a view doesn't use
+        if os.path.exists(path):
+            os.remove(path)
+        connection = sqlite3.connect(path)
+        with connection:
+            connection.execute("CREATE TABLE strings (id INTEGER PRIMARY KEY, text TEXT NOT NULL)")
+            connection.execute("CREATE TABLE columns (name TEXT PRIMARY KEY, typecode TEXT NOT NULL, data BLOB NOT NULL)")
+            connection.executemany("INSERT INTO strings VALUES (?, ?)", enumerate(compact.strings))
+            connection.executemany(
+                "INSERT INTO columns VALUES (?, ?, ?)",
+                [(name, typecode, getattr(compact, name).tobytes()) for name, typecode in self.COLUMNS],
+            )
+        connection.close()
+
+    @classmethod
+    def load(cls, path):
+        store = cls()
+        connection = sqlite3.connect(path)
+        try:
+            store.strings = [text for _, text in connection.execute("SELECT id, text FROM strings ORDER BY id")]
+            store.string_ids = {text: string_id for string_id, text in enumerate(store.strings)}
+            for name, typecode, data in connection.execute("SELECT name, typecode, data FROM columns"):
+                column = array(typecode)
+                column.frombytes(data)
+                setattr(store, name, column)
+        finally:
+            connection.close()
+        store.rows = array("I", range(len(store.fronts)))
+        return store
 
 # this function runs the code on the first number chunks of the pdf (used for testing) but also generally shows the pipeline
-def create_content_flashcards(pdf_path, max_chunks=None):
-    text = extract_text_from_pdf(pdf_path)
+# returns the cards as a CardStore
+# pass the PdfDocument shared with the figure stage as document so the pdf is only opened and parsed once
+# page_numbers limits it to those (0-based) pages, see select_pages
+# chunks are sized in tokens (chunk_tokens, default from CHUNK_TOKENS for the model) and can overlap
+def create_content_flashcards(pdf_path, max_chunks=None, journal=None, document=None, page_numbers=None, batch=False,
+                              chunk_tokens=None, overlap_tokens=CHUNK_OVERLAP_TOKENS):
+    own_document = document is None
+    if own_document:
+        document = PdfDocument(pdf_path)
+    reading = []  # the pages read so far
+
+    def pages():
+        for layout in document.iter_layouts(page_numbers):
+            reading.append(layout.number)
+            yield layout.text
+
+    # Chunk the text as pages are read, limits it to the first `max_chunks` set in def line
+    # a chunk is handed out once the next paragraph doesn't fit, so the page being read then is where the next one starts
+    chunk_tokens = chunk_tokens or chunk_token_budget()
+    chunk_sizes = []
+    chunk_pages = []
 
-    # Chunk the text, limits it to the first `max_chunks` set in def line
-    chunks = chunk_text(text)[:max_chunks]
+    def chunks():
+        for chunk in iter_token_chunks(pages(), chunk_tokens, overlap_tokens, stats=chunk_sizes):
+            chunk_pages.append(reading[0] if not chunk_pages else next_start)
+            next_start = reading[-1]
+            yield chunk
 
     # Generate flashcards for limited chunks using LLM
-    raw_flashcards = generate_flashcards_with_llm(chunks)
+    with instrumentation.span("generate flashcards") as details:
+        chunk_flashcards = generate_flashcards_with_llm(itertools.islice(chunks(), max_chunks), journal, batch=batch)
+        details["chunks"] = len(chunk_flashcards)
+    if own_document:
+        document.close()
+    print(chunk_utilization_report(chunk_sizes, chunk_tokens))
+
+    store = CardStore()
+    for chunk_number, flashcards in enumerate(chunk_flashcards):
+        for front, back in flashcards:
+            store.add(front, back, TEXT_CARD, page=chunk_pages[chunk_number], chunk=chunk_number)
+    return store
+
+STOPWORDS = {"a", "an", "the", "of", "and", "or", "in", "on", "for", "to", "with", "by"}
+
+# strips plural and -ence/-ent style endings so "Independence" and "Independent" normalize the same
+def stem_word(word):
+    for suffix in ("ences", "ence", "ents", "ent", "ance", "ant"):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 4:
+            return word[:-len(suffix)]
+    if word.endswith("ies") and len(word) > 4:
+        return word[:-3] + "y"
+    if word.endswith(("sses", "xes", "ches", "shes")):
+        return word[:-2]
+    if word.endswith("s") and not word.endswith(("ss", "us", "is")) and len(word) > 3:
+        return word[:-1]
+    return word
+
+# lowercases a card front, drops punctuation and filler words and stems what is left
+# words are any unicode letters and digits, so "σ-algebra" keeps its σ and a front like "μ" isn't normalized away
+def normalize_term(text):
+    words = re.findall(r"\w+", text.casefold())
+    return " ".join(stem_word(word) for word in words if word not in STOPWORDS)
+
+# character trigrams of a normalized front (or of the raw front, for one with no words in it)
+def term_shingles(normalized):
+    padded = f" {normalized} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)} or {padded}
+
+# word pairs of a definition
+def definition_shingles(text):
+    words = re.findall(r"\w+", text.casefold())
+    return {" ".join(words[i:i + 2]) for i in range(max(1, len(words) - 1))}
+
+MINHASH_PRIME = 4294967311  # first prime above 2**32
 
-    # Parse and format flashcards
-    parsed_flashcards = []
-    for raw_output in raw_flashcards:
-        parsed_flashcards.extend(parse_llm_output(raw_output))
+# the (a, b) coefficients of the random permutations, drawn from a fixed seed so signatures are the same every run
+@lru_cache(maxsize=None)
+def minhash_permutations():
+    import numpy as np
+    minhash_random = np.random.default_rng(181)
+    a = minhash_random.integers(1, 2**32, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+    b = minhash_random.integers(0, 2**32, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+    return a, b
 
-    return parsed_flashcards
+# minhash signature of a set of shingles: the smallest hash under each of the random permutations
+def minhash_signature(shingles):
+    import numpy as np
+    a, b = minhash_permutations()
+    hashes = np.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+    return ((a[:, None] * hashes[None, :] + b[:, None]) % MINHASH_PRIME).min(axis=1)
 
-def remove_duplicates(flashcards):
-    seen = set()  # track unique fronts
-    unique_flashcards = []
+def jaccard(first, second):
+    return len(first & second) / len(first | second)
 
-    for front, back in flashcards:
-        if front not in seen: 
-            unique_flashcards.append((front, back))
-            seen.add(front)
+# groups cards whose signatures agree on a whole band, so only cards sharing a bucket are ever compared
+def lsh_candidate_pairs(signatures):
+    rows = MINHASH_PERMUTATIONS // LSH_BANDS
+    pairs = set()
+    for band in range(LSH_BANDS):
+        buckets = {}
+        for index, signature in enumerate(signatures):
+            buckets.setdefault(signature[band * rows:(band + 1) * rows].tobytes(), []).append(index)
+        for members in buckets.values():
+            for i in range(len(members)):
+                for j in range(i + 1, len(members)):
+                    pairs.add((members[i], members[j]))
+    return pairs
+
+# finds near-duplicate cards by front (same normalized term, or similar character trigrams) or by definition
+# returns (kept index, dropped index, reason) for each card that should be merged into an earlier one
+def find_near_duplicates(flashcards):
+    normalized = [normalize_term(front) for front, _ in flashcards]
+    fronts = [term_shingles(term or front.casefold().strip()) for term, (front, _) in zip(normalized, flashcards)]
+    backs = [definition_shingles(back) for _, back in flashcards]
+
+    reasons = {}
+    first_with_term = {}
+    for index, term in enumerate(normalized):
+        key = " ".join(sorted(term.split()))  # word order doesn't matter for an exact match
+        if not key:
+            continue  # a front with no words (only symbols) has nothing to match on
+        if key in first_with_term:
+            reasons[(first_with_term[key], index)] = "same normalized term"
+        else:
+            first_with_term[key] = index
+
+    front_signatures = [minhash_signature(shingles) for shingles in fronts]
+    for i, j in lsh_candidate_pairs(front_signatures):
+        similarity = jaccard(fronts[i], fronts[j])
+        if similarity >= DEDUP_FRONT_THRESHOLD:
+            reasons.setdefault((i, j), f"front similarity {similarity:.2f}")
+    back_signatures = [minhash_signature(shingles) for shingles in backs]
+    for i, j in lsh_candidate_pairs(back_signatures):
+        similarity = jaccard(backs[i], backs[j])
+        if similarity >= DEDUP_BACK_THRESHOLD:
+            reasons.setdefault((i, j), f"definition similarity {similarity:.2f}")
+
+    # union-find so chains of near-duplicates all merge into the earliest card
+    parent = list(range(len(flashcards)))
+
+    def root(index):
+        while parent[index] != index:
+            parent[index] = parent[parent[index]]
+            index = parent[index]
+        return index
+
+    merges = []
+    for (i, j), reason in sorted(reasons.items()):
+        kept, dropped = root(i), root(j)
+        if kept == dropped:
+            continue
+        kept, dropped = min(kept, dropped), max(kept, dropped)
+        parent[dropped] = kept
+        merges.append((kept, dropped, reason))
+    return [(root(kept), dropped, reason) for kept, dropped, reason in merges]
+
+# removes exact and near-duplicate cards from a CardStore, keeping the first of each group (returns a view)
+# every merge is written to report_path so it can be checked by hand
+def remove_duplicates(flashcards, report_path=None):
+    merges = find_near_duplicates(flashcards)
+    dropped = {dropped for _, dropped, _ in merges}
+    unique_flashcards = flashcards.take(index for index in range(len(flashcards)) if index not in dropped)
+
+    if merges:
+        print(f"Merged {len(merges)} duplicate flashcards")
+    if report_path:
+        with open(report_path, "w", encoding="utf-8") as report_file:
+            report_file.write("kept\tmerged\treason\n")
+            for kept, merged, reason in merges:
+                report_file.write(f"{flashcards[kept][0]}\t{flashcards[merged][0]}\t{reason}\n")
 
     return unique_flashcards
 
@@ -147,6 +1578,7 @@ Prompt: [Write a clear and concise question or description for the front of a fl
 
 Guidelines:
 - Pay close attention to the sentence following "Figure X.X" as it explains the concept or topic being shown.
+- The caption may be followed by text from the book that refers to the figure. Use it to understand what the figure is about, but write the prompt about the concept, not about that text.
 - Write a question or description about the broader **topic, key relationship, or principle** the figure represents.
 - Do not mention or reference the figure, graph, or visual elements directly (e.g., avoid phrases like “the figure shows” or “the graph represents”).
 - Ensure clarity and conciseness so the learner can understand and guess the back effectively without needing to see the figure.
@@ -155,110 +1587,466 @@ Guidelines:
 Provide the refined flashcard prompt in the exact format described above. Do not include explanations, footnotes, or justifications outside the specified format.
 """
 
+# Added to the caption prompt when several captions are sent in one request
+CAPTION_BATCH_PROMPT = CAPTION_PROMPT + """
+You will be given several numbered captions, each starting with a line like "### CAPTION 1 ###". Write one flashcard for each caption and put the caption's number in its markers, like this:
+
+### BEGIN FLASHCARD 1 ###
+Prompt: [Prompt]
+### END FLASHCARD 1 ###
+"""
+
 #check directory exists
 def ensure_directory(path):
     if not os.path.exists(path):
         os.makedirs(path)
 
-# extracting captions and surrounding text of a labeled figure
-def extract_captions_from_text(page_text, max_words=100):
-    pattern = r"(Figure\s\d+\.\d+(\.\d+)?)"
-    matches = re.finditer(pattern, page_text)
-    captions = []
-    for match in matches:
-        figure_label = match.group(0)
-        start_index = match.end()
-        remaining_text = page_text[start_index:].strip()
-        words = remaining_text.split()
-        caption = " ".join(words[:max_words])
-        captions.append((figure_label, caption))
-    return captions
+# index where the first run of `length` consecutive True values in a 1-d mask ends, or len(mask) if there is none
+# uses a cumulative sum so every window is checked at once instead of walking the mask in python
+def end_of_first_run(mask, length):
+    import numpy as np
+    if length <= 0:
+        return 0
+    if len(mask) < length:
+        return len(mask)
+    counts = np.cumsum(mask, dtype=np.int64)
+    window_sums = counts[length - 1:] - np.concatenate(([0], counts[:-length]))
+    runs = np.flatnonzero(window_sums == length)
+    return int(runs[0]) + length - 1 if runs.size else len(mask)
+
+# this function finds the crop box of a figure in one pass over the pixels
+# image is a pixel array (height x width x channels), or a path to an image file
+# the bottom is where the first band of min_consecutive_white white rows ends, and top/left/right trim the
+# white space around whatever is above that band; returns (top, bottom, left, right)
+def detect_crop_box(image, tolerance=250, min_consecutive_white=15):
+    import numpy as np
+    if isinstance(image, str):
+        from PIL import Image
+        image = np.asarray(Image.open(image))
+    image_array = image
+    height, width, channels = image_array.shape
+    # a row (or column) is white when its darkest channel value is still close to 255
+    white_rows = image_array.reshape(height, width * channels).min(axis=1) >= tolerance
+
+    bottom = end_of_first_run(white_rows, min_consecutive_white)
+    content_rows = ~white_rows[:bottom]
+    content_columns = image_array[:bottom].min(axis=0).min(axis=1) < tolerance
+    if not content_rows.any():
+        return 0, bottom, 0, width
+    top = int(np.argmax(content_rows))
+    left = int(np.argmax(content_columns))
+    right = len(content_columns) - int(np.argmax(content_columns[::-1]))
+    return top, bottom, left, right
 
 # this functin detects a large white margin around a figure so it can crop
-def detect_white_margin(image_path, tolerance=250, min_consecutive_white=15):
-    image = Image.open(image_path)
-    image_array = np.array(image)
-    height, width, _ = image_array.shape
-    consecutive_white_rows = 0
-    for y in range(height):
-        row = image_array[y, :, :]
-        if np.all(row >= tolerance):
-            consecutive_white_rows += 1
-            if consecutive_white_rows >= min_consecutive_white:
-                return y
-        else:
-            consecutive_white_rows = 0
-    return height
+def detect_white_margin(image, tolerance=250, min_consecutive_white=15):
+    return detect_crop_box(image, tolerance, min_consecutive_white)[1]
 
-# Caption refine using prompt from above
-def process_caption_with_llm(caption):
-    response = client.chat.completions.create(
-        messages=[
-            {"role": "system", "content": CAPTION_PROMPT},
-            {"role": "user", "content": f"Refine this caption: {caption}"}
-        ],
-        model=LLM_MODEL
+# zero-copy numpy view (height x width x channels) of a pixmap's sample buffer
+def pixmap_array(pix):
+    import numpy as np
+    return np.ndarray(
+        shape=(pix.height, pix.width, pix.n),
+        dtype=np.uint8,
+        buffer=pix.samples_mv,
+        strides=(pix.stride, pix.n, 1),
     )
-    refined_caption = response.choices[0].message.content.strip()
-    match = re.search(r"### BEGIN FLASHCARD ###\nPrompt: (.*?)\n### END FLASHCARD ###", refined_caption, re.DOTALL)
+
+# encodes a pixel array as png bytes
+def encode_png(pixels):
+    return encode_image(pixels, "png")
+
+# encodes a pixel array as an optimized png or lossless webp
+# pixels with no colour in them are stored as grayscale, and colour pngs get a MEDIA_PNG_COLORS palette (the
+# figures are mostly flat line art with a couple of hundred colours, so that halves the files)
+def encode_image(pixels, image_format=MEDIA_FORMAT):
+    from PIL import Image
+    image = Image.fromarray(pixels)
+    if pixels.ndim == 3 and pixels.shape[2] == 3 and (pixels[:, :, 0] == pixels[:, :, 1]).all() and (pixels[:, :, 1] == pixels[:, :, 2]).all():
+        image = image.convert("L")
+    buffer = io.BytesIO()
+    if image_format == "webp":
+        image.save(buffer, format="WEBP", lossless=True, method=6)
+    else:
+        if image.mode == "RGB" and MEDIA_PNG_COLORS:
+            image = image.quantize(colors=MEDIA_PNG_COLORS, dither=Image.Dither.NONE)
+        image.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+# 64 bit difference hash of a pixel array: shrink to 9x8 gray and note whether each pixel is brighter than the one
+# to its left; re-renders of the same figure (a pixel of anti-aliasing or crop apart) hash within a few bits
+def difference_hash(pixels):
+    import numpy as np
+    from PIL import Image
+    small = np.asarray(Image.fromarray(pixels).convert("L").resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+# one rendered figure: the encoded image, a hash of its exact pixels, its difference hash and its size
+FigureImage = namedtuple("FigureImage", ["data", "content_hash", "dhash", "width", "height"])
+
+# pulls the refined prompt out of the caption response format
+def parse_caption_output(output):
+    match = re.search(r"### BEGIN FLASHCARD ###\nPrompt: (.*?)\n### END FLASHCARD ###", output.strip(), re.DOTALL)
     return match.group(1).strip() if match else "Error in LLM response"
 
-# function to extract figures and captions from the pdf 
-def extract_figures_with_captions(pdf_path):
-    pdf_document = fitz.open(pdf_path)
-    ensure_directory(MEDIA_FOLDER) # checks the folder for saving the pngs exists
-    flashcards = []
-    for page_num in range(len(pdf_document)):
-        page = pdf_document[page_num]
+# splits a batched caption answer into {caption number: refined prompt}
+def parse_batched_caption_output(output):
+    matches = re.findall(r"### BEGIN FLASHCARD (\d+) ###\s*Prompt: (.*?)\s*### END FLASHCARD \1 ###", output, re.DOTALL)
+    return {int(number): prompt.strip() for number, prompt in matches}
+
+# what is sent for one figure: its caption, then the paragraphs around it that refer to it (see FigureIndex)
+def caption_request(figure, page, figure_index):
+    context = figure_index.context(figure.label, page, figure.paragraph)
+    if not context:
+        return figure.caption
+    return f"{figure.caption}\n\nText referring to {figure.label}: {context}"
+
+# Caption refine using prompt from above
+def process_caption_with_llm(caption):
+    return parse_caption_output(call_llm(CAPTION_PROMPT, f"Refine this caption: {caption}", label="caption fallback", stage="captions"))
+
+# refines all the figure captions at once through the dispatcher, keeping the figure order
+# with batch=True several captions share one request; a caption missing from the answer is sent again on its own
+def process_captions_with_llm(captions, on_result=None, batch=False):
+    refined = {}
+    items = list(enumerate(captions))
+    groups = list(pack_batches(items, CAPTION_BATCH_PROMPT, OUTPUT_TOKENS_PER_CAPTION, stage_model("captions"))) if batch else [[item] for item in items]
+
+    def record(index, output):
+        group = groups[index]
+        prompts = parse_batched_caption_output(output) if batch else {1: parse_caption_output(output)}
+        for number, (caption_index, caption) in enumerate(group, start=1):
+            prompt = prompts.get(number)
+            if prompt is None:
+                prompt = process_caption_with_llm(caption) if batch else "Error in LLM response"
+            refined[caption_index] = prompt
+            if on_result:
+                on_result(caption_index, prompt)
+
+    if batch:
+        dispatch_llm_calls(
+            CAPTION_BATCH_PROMPT, [format_batch(group, "CAPTION") for group in groups], label="caption batch", on_result=record,
+            stage="captions",
+        )
+    else:
+        dispatch_llm_calls(
+            CAPTION_PROMPT, [f"Refine this caption: {caption}" for caption in captions], label="caption", on_result=record,
+            stage="captions",
+        )
+    return [refined[i] for i in range(len(captions))]
+
+# renders one figure from its label span and crops it at the white margin below it, returning a FigureImage
+# the page is rasterized once at dpi and the crop is sliced out of those pixels, nothing goes through disk
+def render_figure(page, figure, dpi=FIGURE_DPI, image_format=MEDIA_FORMAT):
+    import fitz
+    import numpy as np
+    x0, y0, x1, y1 = figure.bbox
+
+    # Large crop area that the figure has to fit in
+    cropped_area = fitz.Rect(x0 - 25, y0 - 10, x1 + 350, y1 + 500)
+    with instrumentation.span("render pixmap"):
+        pix = page.get_pixmap(clip=cropped_area, dpi=dpi)
+        pixels = pixmap_array(pix)
+
+    # Detect the white margins and keep what is inside them (the white band is 15 pixels at 72 dpi)
+    with instrumentation.span("detect crop box"):
+        top, bottom, left, right = detect_crop_box(pixels, min_consecutive_white=max(1, round(15 * dpi / 72)))
+    crop = np.ascontiguousarray(pixels[top:bottom, left:right])
+    with instrumentation.span("encode image"):
+        data = encode_image(crop, image_format)
+    content_hash = hashlib.sha1(repr(crop.shape).encode("ascii") + crop.tobytes()).hexdigest()[:16]
+    return FigureImage(data, content_hash, difference_hash(crop), crop.shape[1], crop.shape[0])
+
+# the media folder's images, each stored once under the hash of its pixels (fig_<hash>.png)
+# an image whose difference hash is close to one already saved, and whose pixels are then (almost) all the same, is not
+# written again, its cards point at the saved one; the hashes are kept in MEDIA_INDEX so this works across runs and books
+# an image listed in the index but no longer in the folder (e.g. moved to Anki) is written again
+class MediaStore:
+    def __init__(self, folder, image_format=MEDIA_FORMAT):
+        self.folder = folder
+        self.extension = image_format
+        self.index_path = os.path.join(folder, MEDIA_INDEX)
+        self.index = {}  # file name -> [difference hash, width, height]
+        if os.path.exists(self.index_path):
+            with open(self.index_path, encoding="utf-8") as index_file:
+                self.index = json.load(index_file)
+        self.reused = 0
+        self.lock = threading.Lock()
+
+    # the difference hash only finds candidates: figures of the same layout (a plot with another caption) can hash
+    # a bit apart, so a candidate is only the same image if it has the same size and nearly every pixel matches
+    def find_similar(self, image):
+        for filename, (dhash, width, height) in list(self.index.items()):
+            if (width, height) != (image.width, image.height) or bin(dhash ^ image.dhash).count("1") > MEDIA_DHASH_DISTANCE:
+                continue
+            path = os.path.join(self.folder, filename)
+            if not os.path.exists(path):
+                del self.index[filename]
+            elif same_pixels(path, image.data):
+                return filename
+        return None
+
+    # saves the image unless it (or a near copy) is already there; returns the file name the card should use
+    def add(self, image):
+        filename = f"fig_{image.content_hash}.{self.extension}"
+        with self.lock:
+            if filename in self.index and os.path.exists(os.path.join(self.folder, filename)):
+                self.reused += 1
+                return filename
+            similar = self.find_similar(image)
+            if similar is not None:
+                self.reused += 1
+                return similar
+            ensure_directory(self.folder)
+            with open(os.path.join(self.folder, filename), "wb") as image_file:
+                image_file.write(image.data)
+            self.index[filename] = [image.dhash, image.width, image.height]
+            return filename
+
+    def save(self):
+        with self.lock:
+            ensure_directory(self.folder)
+            with open(self.index_path, "w", encoding="utf-8") as index_file:
+                json.dump(self.index, index_file)
+
+# True if the image saved at path and the encoded image data differ in at most MEDIA_PIXEL_DIFFERENCE of their pixels
+def same_pixels(path, data):
+    import numpy as np
+    from PIL import Image
+    with Image.open(path) as saved_image:
+        saved = np.asarray(saved_image.convert("L"), dtype=np.int16)
+    with Image.open(io.BytesIO(data)) as new_image:
+        new = np.asarray(new_image.convert("L"), dtype=np.int16)
+    if saved.shape != new.shape:
+        return False
+    return (np.abs(saved - new) > 32).mean() <= MEDIA_PIXEL_DIFFERENCE
+
+# one MediaStore per folder, so books worked on at the same time share it
+@lru_cache(maxsize=None)
+def media_store(folder, image_format=MEDIA_FORMAT):
+    return MediaStore(folder, image_format)
+
+# renders the figures on the given pages of an open document
+# pages is a list of (page number, figure spans) where the spans may be None if the page hasn't been parsed yet
+# returns (figure id, page number, FigureImage, FigureSpan) in page order, with no image for figures already finished
+def render_figures_on_pages(document, pages, finished, dpi=FIGURE_DPI, image_format=MEDIA_FORMAT):
+    crops = []
+    for page_num, figure_spans in pages:
         print(f"Processing Page {page_num + 1}...")
-        page_text = page.get_text("text")
-        captions = extract_captions_from_text(page_text)
-        text_dict = page.get_text("dict")
-        for block in text_dict["blocks"]:
-            if "lines" not in block:
+        if figure_spans is None:
+            figure_spans = document.figures_on_page(page_num)
+        for figure_number, figure in enumerate(figure_spans, start=1):
+            figure_id = f"{page_num + 1}:{figure_number}"
+            if figure_id in finished:
+                crops.append((figure_id, page_num, None, None))
                 continue
-            for line in block["lines"]:
-                for span in line["spans"]:
-                    if "Figure" in span["text"] and span["size"] > 10:
-                        is_bold = "Bold" in span["font"] or "Black" in span["font"]
-                        x0, y0, x1, y1 = span["bbox"]
-
-                        if is_bold and x0 < 50:  # Left margin condition
-                            print(f"Found bold 'Figure' in left margin on page {page_num + 1}")
-
-                            # Temporary large crop area
-                            cropped_area = fitz.Rect(x0 - 25, y0 - 10, x1 + 350, y1 + 500)
-                            pix = page.get_pixmap(clip=cropped_area)
-
-                            # Save initial large image
-                            temp_image_path = os.path.join(MEDIA_FOLDER, "temp_image.png")
-                            pix.save(temp_image_path)
-
-                            # Detect white margin
-                            new_bottom = detect_white_margin(temp_image_path)
-                            final_cropped_area = fitz.Rect(x0 - 25, y0 - 10, x1 + 350, y0 + new_bottom)
-
-                            # Render the final cropped area
-                            final_pix = page.get_pixmap(clip=final_cropped_area)
-                            image_filename = f"page_{page_num + 1}_figure.png"
-                            image_path = os.path.join(MEDIA_FOLDER, image_filename)
-                            final_pix.save(image_path)
-
-                            # Find the corresponding caption
-                            caption = next((cap[1] for cap in captions if cap[0] in span["text"]), "None")
-                            refined_caption = process_caption_with_llm(caption)
-
-                            flashcards.append((refined_caption, f"<img src=\"{image_filename}\">"))
-    pdf_document.close()
-    return flashcards
+            crops.append((figure_id, page_num, render_figure(document.page(page_num), figure, dpi, image_format), figure))
+    return crops
+
+# process pool worker: opens its own copy of the pdf and renders the figures on its share of the pages
+# the timing spans recorded in the worker and the figure index of the pages it parsed are sent back with the crops
+def render_figures_worker(pdf_path, pages, finished, dpi=FIGURE_DPI, image_format=MEDIA_FORMAT):
+    instrumentation.take_events()  # drop anything inherited from the parent process
+    document = PdfDocument(pdf_path)
+    try:
+        crops = render_figures_on_pages(document, pages, finished, dpi, image_format)
+        return crops, instrumentation.take_events(), document.figure_index
+    finally:
+        document.close()
+
+# splits the pages into about four tasks per worker so one figure heavy chapter doesn't hold up the rest
+def split_pages(pages, workers):
+    task_count = max(1, min(len(pages), workers * 4))
+    size = -(-len(pages) // task_count)
+    return [pages[i:i + size] for i in range(0, len(pages), size)]
+
+# function to extract figures and captions from the pdf 
+# the figure spans come from the PdfDocument, so pages the text stage already parsed are not parsed again
+# with more than one worker the pages are rendered by a process pool, and this process does the ordering,
+# file naming and the LLM caption refinement
+# page_numbers limits it to those (0-based) pages, see select_pages; the images are rendered at dpi and saved once
+# each in media_folder (see MediaStore) as png or webp
+# returns the cards as a CardStore
+# pass a process pool as executor to share one between several books (see figure_executor)
+def extract_figures_with_captions(pdf_path, journal=None, document=None, workers=FIGURE_WORKERS, page_numbers=None, batch=False,
+                                  media_folder=MEDIA_FOLDER, executor=None, dpi=FIGURE_DPI, image_format=MEDIA_FORMAT):
+    finished = journal.completed("figure") if journal else {}
+    own_document = document is None
+    if own_document:
+        document = PdfDocument(pdf_path)
+    media = media_store(media_folder, image_format)
+
+    # pages the text stage already parsed only need rendering if they actually have figures
+    pages = []
+    for page_num in range(len(document)) if page_numbers is None else page_numbers:
+        figure_spans = document.figure_spans.get(page_num)
+        if figure_spans is None or figure_spans:
+            pages.append((page_num, figure_spans))
+
+    with instrumentation.span("render figures") as details:
+        if pages and (executor is not None or workers > 1):
+            pool = executor or figure_executor(workers)
+            try:
+                tasks = split_pages(pages, workers)
+                results = pool.map(
+                    render_figures_worker, [pdf_path] * len(tasks), tasks, [finished] * len(tasks),
+                    [dpi] * len(tasks), [image_format] * len(tasks),
+                )
+                crops = []
+                for task_crops, events, figure_index in results:
+                    crops.extend(task_crops)
+                    instrumentation.merge_events(events)
+                    document.figure_index.merge(figure_index)
+            finally:
+                if executor is None:
+                    pool.shutdown()
+        else:
+            crops = render_figures_on_pages(document, pages, finished, dpi, image_format)
+        details["figures"] = len(crops)
+    if own_document:
+        document.close()
+
+    # each caption goes out with the text referring to its figure, looked up in the document's figure index
+    figures = []  # (figure id, image filename, caption request, label and caption), refined together below
+    reused = media.reused
+    for figure_id, page_num, image, figure in crops:
+        print(f"Found bold 'Figure' in left margin on page {page_num + 1}")
+        if image is None:
+            figures.append((figure_id, None, None, None))
+            continue
+        figures.append((
+            figure_id, media.add(image), caption_request(figure, page_num, document.figure_index),
+            f"{figure.label}\n{figure.caption}",
+        ))
+    media.save()
+    if media.reused > reused:
+        print(f"{media.reused - reused} figures were already in {media_folder} and were not saved again")
+
+    # refine every new caption in parallel now that the pages have been scanned
+    pending = [figure for figure in figures if figure[0] not in finished]
+    if finished:
+        print(f"Resuming: {len(figures) - len(pending)} of {len(figures)} figures already done")
+
+    # journal records are [front, back, source]; ones written before the source was kept have just [front, back]
+    def record(index, refined_caption):
+        if journal:
+            figure_id, image_filename, _, source = pending[index]
+            journal.record("figure", figure_id, [refined_caption, f"<img src=\"{image_filename}\">", source])
+
+    refined_captions = process_captions_with_llm([caption for _, _, caption, _ in pending], on_result=record, batch=batch)
+    cards = dict(finished)
+    for (figure_id, image_filename, _, source), refined_caption in zip(pending, refined_captions):
+        cards[figure_id] = [refined_caption, f"<img src=\"{image_filename}\">", source]
+    store = CardStore()
+    for figure_id, *_ in figures:
+        front, back, source = (cards[figure_id] + [""])[:3]
+        store.add(front, back, FIGURE_CARD, page=int(figure_id.split(":")[0]) - 1, source=source)
+    return store
+
+# header lines Anki reads when importing the TSV: the first column is the note id, so re-importing updates
+# notes instead of duplicating them, and the last column holds tags
+DECK_HEADER = "#separator:tab\n#html:true\n#guid column:1\n#tags column:4\n"
+CHANGED_TAG = "changed"
+
+# stable id for a card: figure cards are keyed by their image and the label and caption they came from (source),
+# so two figures sharing an image stay two cards, and every other card by its normalized front
+# a front with no words in it ("≤") is keyed by its raw text, behind a NUL no normalized front can contain,
+# so it never shares an id with another symbol-only front or with a worded one
+def card_id(front, back, source=""):
+    if back.startswith("<img"):
+        key = back + source
+    else:
+        key = normalize_term(front) or "\0" + front
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+# the deck is imported as html, so line breaks become <br>
+def clean_field(text):
+    return text.replace("\r\n", "<br>").replace("\r", "<br>").replace("\n", "<br>")
+
+# the deck rows are written and read as csv with tabs, so a field with a tab or a quote in it is quoted
+# (Anki reads the same quoting) instead of splitting the row
+def deck_writer(tsv_file):
+    return csv.writer(tsv_file, delimiter="\t", lineterminator="\n", quoting=csv.QUOTE_MINIMAL)
+
+def deck_row(identifier, front, back, tags=""):
+    return [identifier, front, back, tags]
+
+# reads the rows of an open deck file one at a time; returns (whether it has the header, the rows)
+# every row comes out as (id, front, back, tags), older two column decks without an id column are read too,
+# their ids are worked out from the cards; nothing is collapsed, a repeated card comes out again
+def read_deck_rows(tsv_file):
+    line = tsv_file.readline()
+    has_header = False
+    while line.startswith("#"):  # the header lines
+        has_header = True
+        line = tsv_file.readline()
+
+    def rows():
+        for fields in csv.reader(itertools.chain([line], tsv_file), delimiter="\t"):
+            if has_header and len(fields) >= 3:
+                yield fields[0], fields[1], fields[2], fields[3] if len(fields) > 3 else ""
+            elif not has_header and len(fields) >= 2:
+                yield card_id(fields[0], fields[1]), fields[0], fields[1], ""
+
+    return has_header, rows()
+
+# reads a deck written by save_flashcards_to_tsv into {id: (front, back, tags)} in file order
+def load_deck(file_path):
+    deck = {}
+    if not os.path.exists(file_path):
+        return deck, False
+    with open(file_path, encoding="utf-8", newline="") as tsv_file:
+        has_header, rows = read_deck_rows(tsv_file)
+        for identifier, front, back, tags in rows:
+            if has_header:
+                deck[identifier] = (front, back, tags)
+            else:
+                deck.setdefault(identifier, (front, back, tags))
+    return deck, has_header
 
-# just saving the flashcards to a TSV file
-def save_flashcards_to_tsv(flashcards, filename="flashcards.tsv"):
+# saves the flashcards (a CardStore) to the TSV deck without rewriting cards that are already there
+# new cards are appended, cards whose text changed are updated in place and tagged, and every card added or
+# changed by this run is also written to delta_filename so only those need importing into Anki
+def save_flashcards_to_tsv(flashcards, filename="flashcards.tsv", delta_filename=DELTA_FILE):
     file_path = os.path.join(os.getcwd(), filename)
-    
-    with open(file_path, "w") as tsv_file:
-        for front, back in flashcards:
-            tsv_file.write(f"{front}\t{back}\n")
+    deck, has_header = load_deck(file_path)
+
+    new_cards = {}
+    changed_cards = {}
+    seen = set()
+    for index, (front, back) in enumerate(flashcards):
+        identifier = flashcards.card_id(index)
+        if identifier in seen:
+            continue  # the first card with an id wins, as in remove_duplicates
+        seen.add(identifier)
+        front, back = clean_field(front), clean_field(back)
+        if identifier in deck:
+            if deck[identifier][:2] != (front, back):
+                changed_cards[identifier] = (front, back, CHANGED_TAG)
+        elif identifier not in new_cards:
+            new_cards[identifier] = (front, back, "")
+
+    if changed_cards or not has_header:
+        # a changed card has to be replaced where it is, so this is the one case that rewrites the deck
+        deck.update(changed_cards)
+        deck.update(new_cards)
+        with open(file_path, "w", encoding="utf-8", newline="") as tsv_file:
+            tsv_file.write(DECK_HEADER)
+            deck_writer(tsv_file).writerows(deck_row(identifier, *card) for identifier, card in deck.items())
+    elif new_cards:
+        with open(file_path, "a", encoding="utf-8", newline="") as tsv_file:
+            deck_writer(tsv_file).writerows(deck_row(identifier, *card) for identifier, card in new_cards.items())
+
+    if delta_filename:
+        with open(os.path.join(os.getcwd(), delta_filename), "w", encoding="utf-8", newline="") as delta_file:
+            delta_file.write(DECK_HEADER)
+            deck_writer(delta_file).writerows(
+                deck_row(identifier, *card) for identifier, card in itertools.chain(new_cards.items(), changed_cards.items())
+            )
+
+    print(f"{len(new_cards)} new and {len(changed_cards)} changed flashcards")
+    return new_cards, changed_cards
 
 # function to now ask for pdf instead of have set in this python file
 def ask_for_pdf_file():
@@ -273,32 +2061,285 @@ def ask_for_pdf_file():
         
         return pdf_file
 
-# shuffles the flashcards
+# shuffles the flashcards (only the cards new to the deck end up in a new order, existing ones keep their place)
+# only the row numbers of the CardStore are shuffled, the cards themselves aren't copied
 def jumble_flashcards(flashcards):
-    shuffled_flashcards = flashcards[:]
-    random.shuffle(shuffled_flashcards)
-    return shuffled_flashcards
+    return flashcards.shuffled()
+
+# the delta file goes next to the deck: flashcards.tsv -> flashcards.new.tsv
+def delta_path_for(deck_path):
+    return os.path.splitext(deck_path)[0] + ".new.tsv"
+
+# library entry point: runs the requested stages on one pdf and returns its cards as a CardStore
+# pages and chapters take the same text as --pages and --chapter; a bad selection raises ValueError
+# resume skips chunks and figures finished by an earlier run (see RunJournal)
+# figure_executor is an optional process pool to render the figures in (see figure_executor)
+def make_flashcards(pdf_path, stages=STAGES, resume=False, pages=None, chapters=None, batch=False, chunk_tokens=None,
+                    chunk_overlap=CHUNK_OVERLAP_TOKENS, figure_workers=FIGURE_WORKERS, media_folder=MEDIA_FOLDER,
+                    dedup_report=DEDUP_REPORT, figure_executor=None, figure_dpi=FIGURE_DPI, media_format=MEDIA_FORMAT):
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise ValueError(f"unknown stage {', '.join(sorted(unknown))} (choose from {', '.join(STAGES)})")
+
+    # the pdf is opened and parsed once and shared by both stages
+    document = PdfDocument(pdf_path)
+    book = os.path.splitext(os.path.basename(pdf_path))[0]
+    try:
+        page_numbers = select_pages(document, pages, chapters)
+        if page_numbers is not None:
+            print(f"Working on {len(page_numbers)} of {len(document)} pages")
+
+        # every finished chunk and figure goes into the journal so resume can skip it next time
+        run_info = {
+            "pdf": os.path.abspath(pdf_path), "model": stage_model("keywords"), "text_backend": "pymupdf", "pages": page_numbers,
+            "chunk_tokens": chunk_tokens or chunk_token_budget(), "chunk_overlap": chunk_overlap,
+        }
+        journal = RunJournal(journal_path_for(pdf_path), run_info, resume=resume)
+        try:
+            flashcards = CardStore()
+            if "text" in stages:
+                print("Extracting pdf content...")
+                with instrumentation.span("stage: text", book=book), instrumentation.profile(f"{book}.text"):
+                    raw_content_flashcards = create_content_flashcards(
+                        pdf_path, journal=journal, document=document, page_numbers=page_numbers, batch=batch,
+                        chunk_tokens=chunk_tokens, overlap_tokens=chunk_overlap,
+                    )
+                with instrumentation.span("stage: dedup", book=book, cards=len(raw_content_flashcards)):
+                    flashcards.extend(remove_duplicates(raw_content_flashcards, report_path=dedup_report))
+
+            if "figures" in stages:
+                print("Extracting figures and captions...")
+                with instrumentation.span("stage: figures", book=book), instrumentation.profile(f"{book}.figures"):
+                    figures_flashcards = extract_figures_with_captions(
+                        pdf_path, journal=journal, document=document, workers=figure_workers, page_numbers=page_numbers,
+                        batch=batch, media_folder=media_folder, executor=figure_executor, dpi=figure_dpi,
+                        image_format=media_format,
+                    )
+                flashcards.extend(figures_flashcards)
+        finally:
+            journal.close()
+    finally:
+        document.close()
+    return flashcards
+
+# the pdfs to work on from the command line: a folder stands for every pdf in it, and any other file that
+# isn't a pdf is read as a manifest with one pdf path per line (relative to the manifest, # starts a comment)
+def expand_pdf_paths(paths):
+    pdf_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            pdf_paths.extend(sorted(
+                os.path.join(path, name) for name in os.listdir(path) if name.lower().endswith(".pdf")
+            ))
+        elif path.lower().endswith(".pdf"):
+            pdf_paths.append(path)
+        else:
+            with open(path, encoding="utf-8") as manifest:
+                for line in manifest:
+                    line = line.split("#", 1)[0].strip()
+                    if line:
+                        pdf_paths.append(os.path.join(os.path.dirname(path), line))
+    return pdf_paths
+
+# a book's journal, outline cache, dedup report and (with --deck-per-book) deck are named after its pdf, so two pdfs
+# with the same name in one job would write over each other's files; raises ValueError naming them
+def check_book_names(pdf_paths):
+    paths_by_book = {}
+    for pdf_path in pdf_paths:
+        paths_by_book.setdefault(os.path.splitext(os.path.basename(pdf_path))[0], []).append(pdf_path)
+    clashes = [paths for paths in paths_by_book.values() if len(paths) > 1]
+    if clashes:
+        raise ValueError(
+            "pdfs with the same file name can't be in one job, rename or run them separately: "
+            + "; ".join(", ".join(paths) for paths in clashes)
+        )
+
+# a process pool for rendering figures that several books can share
+# new workers are spawned rather than forked, because by then other threads are busy with LLM requests
+def figure_executor(workers=FIGURE_WORKERS):
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
 
-def execution():
-    # ask for pdf file path to work on
-    pdf_file = ask_for_pdf_file()
+# makes the cards for several pdfs at once and yields (pdf path, cards) in the order the pdfs were given
+# up to books_at_once books are worked on together: their LLM requests all go through the same workers and rate
+# limiter, and their figures are rendered in one shared process pool, so the API quota is what sets the pace
+# options are passed on to make_flashcards; every book gets its own journal and dedup report, so the pdfs need
+# different file names (see check_book_names)
+def make_flashcards_for_books(pdf_paths, books_at_once=BOOKS_AT_ONCE, **options):
+    check_book_names(pdf_paths)
+    if len(pdf_paths) == 1:
+        yield pdf_paths[0], make_flashcards(pdf_paths[0], **options)
+        return
 
-    # content flashcards
-    print("Extracting pdf content...")
-    raw_content_flashcards = create_content_flashcards(pdf_file)
-    content_flashcards = remove_duplicates(raw_content_flashcards)
+    workers = options.get("figure_workers", FIGURE_WORKERS)
+    shared_pool = figure_executor(workers) if workers > 1 and "figures" in options.get("stages", STAGES) else None
 
-    # figures flashcards
-    print("Extracting figures and captions...")
-    figures_flashcards = extract_figures_with_captions(pdf_file)
+    def make_book(pdf_path):
+        book = os.path.splitext(os.path.basename(pdf_path))[0]
+        return make_flashcards(
+            pdf_path, dedup_report=book + DEDUP_REPORT_SUFFIX, figure_executor=shared_pool, **options
+        )
+
+    try:
+        with ThreadPoolExecutor(max_workers=books_at_once, thread_name_prefix="book") as executor:
+            futures = [executor.submit(make_book, pdf_path) for pdf_path in pdf_paths]
+            for pdf_path, future in zip(pdf_paths, futures):
+                yield pdf_path, future.result()
+    finally:
+        if shared_pool is not None:
+            shared_pool.shutdown()
+
+# library entry point for a whole deck: makes the cards for every pdf and merges them into the deck at output
+# (see save_flashcards_to_tsv), the other options are passed on to make_flashcards; returns (new cards, changed cards)
+# with apkg=True the whole deck is also written as an Anki package next to it (see save_apkg)
+def build_deck(pdf_paths, output=TSV_FILE, books_at_once=BOOKS_AT_ONCE, apkg=False, **options):
+    all_flashcards = CardStore()
+    for _, flashcards in make_flashcards_for_books(pdf_paths, books_at_once, **options):
+        all_flashcards.extend(flashcards)
+    result = save_deck(all_flashcards, output)
+    if apkg:
+        save_apkg(output, options.get("media_folder", MEDIA_FOLDER))
+    return result
+
+# like build_deck but every pdf gets its own deck, <deck_folder>/<pdf name>.tsv; returns {pdf path: (new, changed)}
+def build_decks(pdf_paths, deck_folder, books_at_once=BOOKS_AT_ONCE, apkg=False, **options):
+    results = {}
+    for pdf_path, flashcards in make_flashcards_for_books(pdf_paths, books_at_once, **options):
+        book = os.path.splitext(os.path.basename(pdf_path))[0]
+        deck_path = os.path.join(deck_folder, book + ".tsv")
+        results[pdf_path] = save_deck(flashcards, deck_path)
+        if apkg:
+            save_apkg(deck_path, options.get("media_folder", MEDIA_FOLDER))
+    return results
+
+# save the flashcards in a TSV format for Anki, and the CardStore with their pages and chunks next to it
+# of cards sharing an id (e.g. a recurring figure) the first one is kept, before the shuffle so it's the same every run
+def save_deck(flashcards, output):
+    seen = set()
+    unique = []
+    for index in range(len(flashcards)):
+        identifier = flashcards.card_id(index)
+        if identifier not in seen:
+            seen.add(identifier)
+            unique.append(index)
+    flashcards = jumble_flashcards(flashcards.take(unique))
+    print(f"Saving flashcards to {output}...")
+    ensure_directory(os.path.dirname(output) or ".")
+    flashcards.save(os.path.splitext(output)[0] + CARD_STORE_SUFFIX)
+    with instrumentation.span("stage: save deck", deck=output, cards=len(flashcards)):
+        return save_flashcards_to_tsv(flashcards, output, delta_path_for(output))
+
+# the apkg goes next to the deck too: flashcards.tsv -> flashcards.apkg
+def apkg_path_for(deck_path):
+    return os.path.splitext(deck_path)[0] + ".apkg"
+
+# writes every card of the TSV deck at deck_path, with the figures it shows from media_folder, as one Anki package
+# the deck in Anki is named after the deck file and the notes keep their TSV ids as guids; returns the package path
+# the rows go from the csv reader straight into the package, only the ids already written are kept in memory
+def save_apkg(deck_path, media_folder=MEDIA_FOLDER):
+    from anki_package import write_apkg
+
+    path = apkg_path_for(deck_path)
+    deck_name = os.path.splitext(os.path.basename(deck_path))[0]
+    seen = set()
+
+    def unique_notes(rows):
+        for identifier, front, back, tags in rows:
+            if identifier not in seen:  # the first card with an id wins, as in load_deck for older decks
+                seen.add(identifier)
+                yield identifier, front, back, tags
+
+    with instrumentation.span("stage: save apkg", deck=path) as args, \
+            open(deck_path, encoding="utf-8", newline="") as tsv_file:
+        _, rows = read_deck_rows(tsv_file)
+        notes, images, missing = write_apkg(unique_notes(rows), path, deck_name, media_folder)
+        args.update(notes=notes, images=images)
+    print(f"Anki package with {notes} cards and {images} images written to {path}")
+    if missing:
+        print(f"Warning: {len(missing)} images the cards use aren't in {media_folder}, e.g. {missing[0]}")
+    return path
+
+# command line options
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Turn a pdf textbook into Anki flashcards.")
+    parser.add_argument("pdfs", nargs="*", help="pdf files, folders of pdfs or manifest files listing pdfs (asked for when none are given)")
+    parser.add_argument("-o", "--output", default=TSV_FILE, help=f"deck file to add the cards to (default {TSV_FILE}), the new cards also go to <name>.new.tsv")
+    parser.add_argument("--deck-per-book", metavar="FOLDER", help="write a deck for each pdf to FOLDER/<pdf name>.tsv instead of one merged deck")
+    parser.add_argument("--books-at-once", type=int, default=BOOKS_AT_ONCE, help=f"pdfs worked on at the same time (default {BOOKS_AT_ONCE})")
+    parser.add_argument("--apkg", action="store_true", help="also write the deck with its figures as an Anki package, <deck name>.apkg, to import in one step")
+    parser.add_argument("--media", default=MEDIA_FOLDER, help=f"folder the figure pngs are saved in (default {MEDIA_FOLDER})")
+    parser.add_argument("--stages", default=",".join(STAGES), help=f"comma separated stages to run (default {','.join(STAGES)})")
+    parser.add_argument("--resume", action="store_true", help="skip chunks and figures finished by a previous run of the same pdf")
+    parser.add_argument("--pages", help="only these pages, e.g. 10-40,55 (numbered from 1 like a pdf viewer)")
+    parser.add_argument("--chapter", help="only these chapters or sections, e.g. 3,4 or 3.2, found from the pdf outline or its headings")
+    parser.add_argument("--batch", action="store_true", help="pack several chunks or captions into each LLM request to send fewer requests")
+    parser.add_argument("--chunk-tokens", type=int, help=f"target tokens per text chunk (default {chunk_token_budget()} for {LLM_MODEL})")
+    parser.add_argument("--chunk-overlap", type=int, default=CHUNK_OVERLAP_TOKENS, help="tokens repeated from the end of one chunk at the start of the next")
+    parser.add_argument("--figure-dpi", type=int, default=FIGURE_DPI, help=f"resolution the figures are rendered at (default {FIGURE_DPI})")
+    parser.add_argument("--media-format", choices=["png", "webp"], default=MEDIA_FORMAT, help=f"figure image format (default {MEDIA_FORMAT})")
+    parser.add_argument("--figure-workers", type=int, default=FIGURE_WORKERS, help="processes used to render figures (1 to render in this process)")
+    parser.add_argument("--model", help=f"model for every LLM request (default {LLM_MODEL})")
+    parser.add_argument("--base-url", help="send the LLM requests to this OpenAI compatible endpoint instead of Groq, e.g. http://localhost:8080/v1 for a local llama.cpp or vLLM server")
+    parser.add_argument("--caption-model", help="model for the figure caption requests only, e.g. a small fast local model")
+    parser.add_argument("--caption-base-url", help="OpenAI compatible endpoint for the figure caption requests only")
+    parser.add_argument("--endpoint-rpm", type=int, help="requests per minute allowed to each --base-url / --caption-base-url endpoint (default no limit, Groq keeps its free tier limits)")
+    parser.add_argument("--endpoint-tpm", type=int, help="tokens per minute allowed to each --base-url / --caption-base-url endpoint (default no limit)")
+    parser.add_argument("--trace", default=TRACE_FILE, help=f"where to write the timing trace and LLM stats (default {TRACE_FILE})")
+    parser.add_argument("--profile", action="store_true", help=f"run the text and figure stages under cProfile and save the stats in {PROFILE_FOLDER}/")
+    args = parser.parse_args(argv)
+    args.stages = tuple(stage.strip() for stage in args.stages.split(",") if stage.strip())
+    unknown = set(args.stages) - set(STAGES)
+    if unknown or not args.stages:
+        parser.error(f"--stages takes a comma separated list of {', '.join(STAGES)}")
+    for path in args.pdfs:
+        if not os.path.exists(path):
+            parser.error(f"file '{path}' not found")
+    try:
+        args.pdfs = expand_pdf_paths(args.pdfs)
+    except OSError as error:
+        parser.error(f"can't read manifest: {error}")
+    for pdf_file in args.pdfs:
+        if not os.path.isfile(pdf_file):
+            parser.error(f"file '{pdf_file}' not found")
+    try:
+        check_book_names(args.pdfs)
+    except ValueError as error:
+        parser.error(str(error))
+    return args
+
+def execution(argv=None):
+    args = parse_arguments(argv)
+    if args.profile:
+        instrumentation.profile_folder = PROFILE_FOLDER
+    configure_llm(model=args.model, base_url=args.base_url, requests_per_minute=args.endpoint_rpm, tokens_per_minute=args.endpoint_tpm)
+    configure_llm("captions", model=args.caption_model, base_url=args.caption_base_url, requests_per_minute=args.endpoint_rpm, tokens_per_minute=args.endpoint_tpm)
+
+    # ask for pdf file path to work on if none was given
+    pdf_files = args.pdfs or [ask_for_pdf_file()]
+
+    options = dict(
+        books_at_once=args.books_at_once, stages=args.stages, resume=args.resume, pages=args.pages, chapters=args.chapter,
+        apkg=args.apkg, batch=args.batch, chunk_tokens=args.chunk_tokens, chunk_overlap=args.chunk_overlap,
+        figure_workers=args.figure_workers, media_folder=args.media, figure_dpi=args.figure_dpi, media_format=args.media_format,
+    )
+    try:
+        if args.deck_per_book:
+            build_decks(pdf_files, args.deck_per_book, **options)
+        else:
+            build_deck(pdf_files, output=args.output, **options)
+    except ValueError as error:
+        raise SystemExit(f"Error: {error}")
 
-    # save both sets of flashcards in a TSV format for Anki
-    all_flashcards = content_flashcards + figures_flashcards
-    flashcards = jumble_flashcards(all_flashcards)
-    print(f"Saving flashcards to {TSV_FILE}...")
-    save_flashcards_to_tsv(flashcards)
+    stats = response_cache.stats()
+    print(f"LLM cache: {stats['hits']} hits, {stats['misses']} misses")
+    print(instrumentation.report())
+    instrumentation.export(args.trace)
+    print(f"Timing trace written to {args.trace}")
 
-    print("Flashcards created successfully! Make sure to follow the instruction of how to move the images to Anki's media folder.")
+    if args.apkg:
+        print("Flashcards created successfully! Import the .apkg in Anki, the figures found in the media folder are in it.")
+    else:
+        print("Flashcards created successfully! Make sure to follow the instruction of how to move the images to Anki's media folder.")
 
 # executions!
-execution()
\ No newline at end of file
+if __name__ == "__main__":
+    execution()
@@ -0,0 +1,159 @@
+import os
+import re
+import json
+import time
+import hashlib
+import sqlite3
+import zipfile
+import tempfile
+
+# writes an Anki package (.apkg): a zip holding the deck as an Anki collection (collection.anki2, the SQLite
+# schema Anki 2.1 still imports) plus every image the cards use, so the whole deck is imported by opening one file
+# notes keep the guid they have in the TSV deck, so importing the package again (or after the TSV) updates the
+# same notes instead of adding copies
+
+MODEL_NAME = "MasteryCards Basic"
+FIELD_SEPARATOR = "\x1f"
+IMAGE_SOURCE = re.compile(r"<img[^>]*\ssrc=[\"']([^\"']+)[\"']", re.IGNORECASE)
+HTML_TAG = re.compile(r"<[^>]+>")
+
+SCHEMA = """
+CREATE TABLE col (
+    id integer primary key, crt integer not null, mod integer not null, scm integer not null, ver integer not null,
+    dty integer not null, usn integer not null, ls integer not null, conf text not null, models text not null,
+    decks text not null, dconf text not null, tags text not null
+);
+CREATE TABLE notes (
+    id integer primary key, guid text not null, mid integer not null, mod integer not null, usn integer not null,
+    tags text not null, flds text not null, sfld integer not null, csum integer not null, flags integer not null,
+    data text not null
+);
+CREATE TABLE cards (
+    id integer primary key, nid integer not null, did integer not null, ord integer not null, mod integer not null,
+    usn integer not null, type integer not null, queue integer not null, due integer not null, ivl integer not null,
+    factor integer not null, reps integer not null, lapses integer not null, left integer not null,
+    odue integer not null, odid integer not null, flags integer not null, data text not null
+);
+CREATE TABLE revlog (
+    id integer primary key, cid integer not null, usn integer not null, ease integer not null, ivl integer not null,
+    lastIvl integer not null, factor integer not null, time integer not null, type integer not null
+);
+CREATE TABLE graves (usn integer not null, oid integer not null, type integer not null);
+CREATE INDEX ix_notes_usn on notes (usn);
+CREATE INDEX ix_cards_usn on cards (usn);
+CREATE INDEX ix_revlog_usn on revlog (usn);
+CREATE INDEX ix_cards_nid on cards (nid);
+CREATE INDEX ix_cards_sched on cards (did, queue, due);
+CREATE INDEX ix_revlog_cid on revlog (cid);
+CREATE INDEX ix_notes_csum on notes (csum);
+"""
+
+# ids Anki uses to match the note type and deck on import, worked out from their names so they never change
+def stable_id(name):
+    return int(hashlib.sha1(name.encode("utf-8")).hexdigest()[:12], 16)
+
+# the first 8 hex digits of the sha1 of the sort field with its html removed, as Anki stores it
+def field_checksum(text):
+    return int(hashlib.sha1(HTML_TAG.sub("", text).encode("utf-8")).hexdigest()[:8], 16)
+
+def note_model(model_id, deck_id, now):
+    return {
+        "id": model_id, "name": MODEL_NAME, "type": 0, "mod": now, "usn": -1, "sortf": 0, "did": deck_id,
+        "tmpls": [{
+            "name": "Card 1", "ord": 0, "qfmt": "{{Front}}", "afmt": "{{FrontSide}}\n\n<hr id=answer>\n\n{{Back}}",
+            "did": None, "bqfmt": "", "bafmt": "",
+        }],
+        "flds": [
+            {"name": name, "ord": ord, "sticky": False, "rtl": False, "font": "Arial", "size": 20, "media": []}
+            for ord, name in enumerate(["Front", "Back"])
+        ],
+        "css": ".card {\n font-family: arial;\n font-size: 20px;\n text-align: center;\n color: black;\n background-color: white;\n}\n",
+        "latexPre": "\\documentclass[12pt]{article}\n\\special{papersize=3in,5in}\n\\usepackage[utf8]{inputenc}\n"
+                    "\\usepackage{amssymb,amsmath}\n\\pagestyle{empty}\n\\setlength{\\parindent}{0in}\n\\begin{document}\n",
+        "latexPost": "\\end{document}", "latexsvg": False, "req": [[0, "any", [0]]], "tags": [], "vers": [],
+    }
+
+def deck_entry(deck_id, name, now):
+    return {
+        "id": deck_id, "name": name, "mod": now, "usn": -1, "lrnToday": [0, 0], "revToday": [0, 0], "newToday": [0, 0],
+        "timeToday": [0, 0], "collapsed": False, "browserCollapsed": False, "desc": "", "dyn": 0, "conf": 1,
+        "extendNew": 0, "extendRev": 0,
+    }
+
+def deck_options(now):
+    return {
+        "id": 1, "name": "Default", "mod": now, "usn": -1, "maxTaken": 60, "autoplay": True, "timer": 0, "replayq": True,
+        "dyn": False,
+        "new": {"bury": True, "delays": [1.0, 10.0], "initialFactor": 2500, "ints": [1, 4, 7], "order": 1, "perDay": 20,
+                "separate": True},
+        "rev": {"bury": True, "ease4": 1.3, "fuzz": 0.05, "ivlFct": 1.0, "maxIvl": 36500, "minSpace": 1, "perDay": 200},
+        "lapse": {"delays": [10.0], "leechAction": 0, "leechFails": 8, "minInt": 1, "mult": 0.0},
+    }
+
+def collection_config(deck_id, model_id):
+    return {
+        "activeDecks": [deck_id], "curDeck": deck_id, "newSpread": 0, "collapseTime": 1200, "timeLim": 0,
+        "estTimes": True, "dueCounts": True, "curModel": model_id, "nextPos": 1, "sortType": "noteFld",
+        "sortBackwards": False, "addToCur": True,
+    }
+
+# writes notes, an iterable of (guid, front, back, tags), into an .apkg at path as the deck deck_name
+# the notes are written to the collection as they are read, and the images their fields refer to (<img src=...>)
+# are taken from media_folder; returns (notes written, images bundled, images missing from media_folder)
+def write_apkg(notes, path, deck_name, media_folder):
+    now = int(time.time())
+    model_id = stable_id(MODEL_NAME)
+    deck_id = stable_id(deck_name)
+    media = {}  # file name -> its number in the zip, in the order the cards use them
+
+    def rows():
+        base_id = now * 1000  # note and card ids only need to be unique, Anki matches notes by guid
+        for position, (guid, front, back, tags) in enumerate(notes):
+            for field in (front, back):
+                for filename in IMAGE_SOURCE.findall(field):
+                    media.setdefault(filename, len(media))
+            tags = f" {tags.strip()} " if tags.strip() else ""
+            yield (base_id + position, guid, model_id, now, -1, tags, front + FIELD_SEPARATOR + back,
+                   HTML_TAG.sub("", front), field_checksum(front), 0, "")
+
+    folder = os.path.dirname(os.path.abspath(path))
+    with tempfile.TemporaryDirectory(dir=folder) as work_folder:
+        collection_path = os.path.join(work_folder, "collection.anki2")
+        connection = sqlite3.connect(collection_path)
+        with connection:
+            connection.executescript(SCHEMA)
+            connection.execute(
+                "INSERT INTO col VALUES (1, ?, ?, ?, 11, 0, 0, 0, ?, ?, ?, ?, '{}')",
+                (
+                    now, now * 1000, now * 1000,
+                    json.dumps(collection_config(deck_id, model_id)),
+                    json.dumps({str(model_id): note_model(model_id, deck_id, now)}),
+                    json.dumps({"1": deck_entry(1, "Default", now), str(deck_id): deck_entry(deck_id, deck_name, now)}),
+                    json.dumps({"1": deck_options(now)}),
+                ),
+            )
+            connection.executemany("INSERT INTO notes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows())
+            # one new card per note, due in the order the notes were given
+            connection.execute(
+                "INSERT INTO cards SELECT id, id, ?, 0, ?, -1, 0, 0, id - ? + 1, 0, 0, 0, 0, 0, 0, 0, 0, '' FROM notes",
+                (deck_id, now, now * 1000),
+            )
+            note_count = connection.execute("SELECT COUNT(*) FROM notes").fetchone()[0]
+        connection.close()
+
+        # the images are already compressed, so they are stored in the zip as they are
+        partial_path = path + ".partial"
+        bundled = {}
+        missing = []
+        with zipfile.ZipFile(partial_path, "w", zipfile.ZIP_DEFLATED) as package:
+            package.write(collection_path, "collection.anki2")
+            for filename, number in media.items():
+                image_path = os.path.join(media_folder, filename)
+                if not os.path.isfile(image_path):
+                    missing.append(filename)
+                    continue
+                package.write(image_path, str(number), compress_type=zipfile.ZIP_STORED)
+                bundled[str(number)] = filename
+            package.writestr("media", json.dumps(bundled))
+        os.replace(partial_path, path)
+    return note_count, len(bundled), missing
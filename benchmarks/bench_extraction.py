@@ -0,0 +1,93 @@
+import os
+import re
+import sys
+import json
+import time
+import resource
+import argparse
+import subprocess
+
+# lets the benchmark import MasteryCards.py from the folder above
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BACKENDS = ["pypdf2", "pymupdf"]
+
+# the caption search the old path ran on the text of every page, kept here since the pipeline now reads captions
+# from the paragraph of each figure's label (see parse_page_layout)
+def extract_captions_from_text(page_text, max_words=100):
+    pattern = r"(Figure\s\d+\.\d+(\.\d+)?)"
+    matches = re.finditer(pattern, page_text)
+    captions = []
+    for match in matches:
+        figure_label = match.group(0)
+        start_index = match.end()
+        remaining_text = page_text[start_index:].strip()
+        words = remaining_text.split()
+        caption = " ".join(words[:max_words])
+        captions.append((figure_label, caption))
+    return captions
+
+# the old extraction path: PyPDF2 for the text, then fitz again with get_text("text") and get_text("dict") per page
+def run_pypdf2(pdf_path):
+    import fitz
+    import MasteryCards
+
+    pages = 0
+    for text in MasteryCards.iter_pdf_pages(pdf_path):
+        pages += 1
+    pdf_document = fitz.open(pdf_path)
+    for page in pdf_document:
+        extract_captions_from_text(page.get_text("text"))
+        page.get_text("dict")
+    pdf_document.close()
+    return pages
+
+# the shared PdfDocument: one parse per page feeds both the text and the figure stage
+def run_pymupdf(pdf_path):
+    import MasteryCards
+
+    document = MasteryCards.PdfDocument(pdf_path)
+    pages = 0
+    for text in MasteryCards.iter_document_pages(document):
+        pages += 1
+    for number in range(len(document)):
+        document.figures_on_page(number)
+    document.close()
+    return pages
+
+# runs one backend in this process and prints its numbers as json for the parent
+def measure(backend, pdf_path):
+    run = run_pypdf2 if backend == "pypdf2" else run_pymupdf
+    start = time.perf_counter()
+    pages = run(pdf_path)
+    elapsed = time.perf_counter() - start
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kilobytes on linux
+    print(json.dumps({"backend": backend, "pages": pages, "seconds": elapsed, "peak_rss_mb": peak_rss_mb}))
+
+# each backend runs in its own process so the peak RSS numbers don't include each other
+def compare(pdf_paths, repeat):
+    print(f"{'pdf':<20}{'backend':<10}{'pages':>7}{'pages/s':>10}{'peak RSS MB':>14}")
+    for pdf_path in pdf_paths:
+        for backend in BACKENDS:
+            runs = []
+            for _ in range(repeat):
+                output = subprocess.run(
+                    [sys.executable, __file__, "--measure", backend, pdf_path],
+                    check=True, capture_output=True, text=True,
+                ).stdout
+                runs.append(json.loads(output.strip().splitlines()[-1]))
+            best = min(runs, key=lambda result: result["seconds"])
+            pages_per_second = best["pages"] / best["seconds"]
+            peak = max(result["peak_rss_mb"] for result in runs)
+            print(f"{os.path.basename(pdf_path):<20}{backend:<10}{best['pages']:>7}{pages_per_second:>10.1f}{peak:>14.1f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the PyPDF2 + fitz extraction path with the shared PyMuPDF document.")
+    parser.add_argument("pdfs", nargs="*", default=["practice_text.pdf", "text1.pdf"])
+    parser.add_argument("--repeat", type=int, default=3, help="runs per backend, the fastest is reported")
+    parser.add_argument("--measure", nargs=2, metavar=("BACKEND", "PDF"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.measure:
+        measure(*args.measure)
+    else:
+        compare(args.pdfs, args.repeat)
@@ -0,0 +1,111 @@
+import os
+import sys
+import json
+import shutil
+import resource
+import argparse
+import tempfile
+import subprocess
+
+from mock_llm_server import start_server, add_settings_arguments, settings_from_arguments
+
+# runs the whole MasteryCards pipeline (execution()) against the local mock LLM server and reports
+# pages/s, chunks/s, figures/s and peak memory per pdf, so a slower stage shows up without any network
+# every run gets its own empty folder, so there is no response cache, journal or deck from an earlier run
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# runs execution() in this process (started by run_pipeline in a temporary folder) and prints its numbers as json
+def measure(pdf_path, client_rpm, client_tpm, pipeline_args):
+    sys.path.insert(0, REPO)
+    import MasteryCards
+
+    MasteryCards.rate_limiter = MasteryCards.RateLimiter(client_rpm, client_tpm)
+    trace_path = os.path.abspath("bench_trace.json")
+    with open(os.devnull, "w") as quiet:
+        stdout, sys.stdout = sys.stdout, quiet
+        try:
+            MasteryCards.execution([pdf_path, "--trace", trace_path] + pipeline_args)
+        finally:
+            sys.stdout = stdout
+
+    with open(trace_path, encoding="utf-8") as trace_file:
+        trace = json.load(trace_file)
+    spans = {}
+    for event in trace["traceEvents"]:
+        spans.setdefault(event["name"], []).append(event)
+    stage_seconds = {name: sum(event["dur"] for event in events) / 1e6 for name, events in spans.items() if name.startswith("stage: ")}
+    # peak of this process and, separately, of its child processes (the figure workers)
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    worker_peak_rss_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    print(json.dumps({
+        "pages": len({event["args"]["page"] for event in spans.get("parse page", [])}),
+        "chunks": sum(event["args"].get("chunks", 0) for event in spans.get("generate flashcards", [])),
+        "figures": sum(event["args"].get("figures", 0) for event in spans.get("render figures", [])),
+        "stages": stage_seconds,
+        "llm": trace["summary"]["llm"],
+        "peak_rss_mb": peak_rss_mb,
+        "worker_peak_rss_mb": worker_peak_rss_mb,
+    }))
+
+# one full run in a fresh folder with the pdf copied in, talking to the mock server at base_url
+def run_pipeline(pdf_path, base_url, args):
+    with tempfile.TemporaryDirectory(prefix="masterycards-bench-") as folder:
+        shutil.copy(pdf_path, folder)
+        env = dict(os.environ, GROQ_BASE_URL=base_url, GROQ_API_KEY="benchmark")
+        command = [
+            sys.executable, os.path.abspath(__file__), "--measure", os.path.basename(pdf_path),
+            "--client-rpm", str(args.client_rpm), "--client-tpm", str(args.client_tpm), "--",
+        ] + args.pipeline_args
+        output = subprocess.run(
+            command, cwd=folder, env=env, check=True, capture_output=True, text=True,
+        ).stdout
+        return json.loads(output.strip().splitlines()[-1])
+
+def report(pdf_path, result):
+    stages = result["stages"]
+    text_seconds = stages.get("stage: text", 0.0)
+    figure_seconds = stages.get("stage: figures", 0.0)
+    total = sum(stages.values())
+    llm = result["llm"]
+    print(
+        f"{os.path.basename(pdf_path):<20}{result['pages']:>6}{result['pages'] / total:>9.1f}"
+        f"{result['chunks']:>7}{result['chunks'] / text_seconds if text_seconds else 0:>9.2f}"
+        f"{result['figures']:>8}{result['figures'] / figure_seconds if figure_seconds else 0:>10.2f}"
+        f"{llm['sent']:>6}{llm['retries']:>8}{llm['p95_latency']:>9.2f}"
+        f"{result['peak_rss_mb']:>10.1f}{result['worker_peak_rss_mb']:>10.1f}"
+    )
+    print("    " + ", ".join(f"{name[len('stage: '):]} {seconds:.2f}s" for name, seconds in stages.items()))
+
+def compare(args):
+    server = start_server(settings_from_arguments(args))
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    print(f"{'pdf':<20}{'pages':>6}{'pages/s':>9}{'chunks':>7}{'chunks/s':>9}{'figures':>8}{'figures/s':>10}"
+          f"{'calls':>6}{'retries':>8}{'p95 s':>9}{'RSS MB':>10}{'children':>10}")
+    try:
+        for pdf_path in args.pdfs:
+            runs = [run_pipeline(pdf_path, base_url, args) for _ in range(args.repeat)]
+            report(pdf_path, min(runs, key=lambda result: sum(result["stages"].values())))
+    finally:
+        server.shutdown()
+    counts = server.settings.counts
+    print(f"mock server: {counts['requests']} requests, {counts['rate_limited']} answered 429, {counts['errors']} answered 500")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the full pipeline offline against a mock LLM server and report its throughput.")
+    parser.add_argument("pdfs", nargs="*", default=[os.path.join(REPO, "practice_text.pdf"), os.path.join(REPO, "text1.pdf")])
+    parser.add_argument("--repeat", type=int, default=1, help="runs per pdf, the fastest is reported")
+    parser.add_argument("--client-rpm", type=int, default=6000, help="requests per minute the pipeline's own rate limiter allows")
+    parser.add_argument("--client-tpm", type=int, default=10**8, help="tokens per minute the pipeline's own rate limiter allows")
+    add_settings_arguments(parser)
+    parser.add_argument("--measure", metavar="PDF", help=argparse.SUPPRESS)
+    parser.epilog = "options after -- are passed on to MasteryCards.py, e.g. -- --batch --figure-workers 1"
+    # everything after -- belongs to MasteryCards.py
+    argv = sys.argv[1:]
+    split = argv.index("--") if "--" in argv else len(argv)
+    args = parser.parse_args(argv[:split])
+    args.pipeline_args = argv[split + 1:]
+    if args.measure:
+        measure(args.measure, args.client_rpm, args.client_tpm, args.pipeline_args)
+    else:
+        compare(args)
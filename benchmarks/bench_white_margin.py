@@ -0,0 +1,64 @@
+import os
+import sys
+import glob
+import time
+import argparse
+
+import numpy as np
+from PIL import Image
+
+# lets the benchmark import MasteryCards.py from the folder above
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import MasteryCards
+
+# the row by row loop detect_white_margin used before it was vectorized, kept here as the baseline
+def detect_white_margin_loop(image_array, tolerance=250, min_consecutive_white=15):
+    height, width, _ = image_array.shape
+    consecutive_white_rows = 0
+    for y in range(height):
+        row = image_array[y, :, :]
+        if np.all(row >= tolerance):
+            consecutive_white_rows += 1
+            if consecutive_white_rows >= min_consecutive_white:
+                return y
+        else:
+            consecutive_white_rows = 0
+    return height
+
+# best of `repeat` timings of running detector over every image
+def time_detector(detector, images, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for image in images:
+            detector(image)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time white margin detection over the figure images in anki_media.")
+    parser.add_argument("--media", default=os.path.join(ROOT, MasteryCards.MEDIA_FOLDER))
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    images = [np.asarray(Image.open(path).convert("RGB")) for path in sorted(glob.glob(os.path.join(args.media, "*.png")))]
+    if not images:
+        sys.exit(f"No png files found in {args.media}")
+
+    # the vectorized bottom edge has to match the loop exactly
+    mismatches = sum(detect_white_margin_loop(image) != MasteryCards.detect_white_margin(image) for image in images)
+
+    detectors = [
+        ("row loop (bottom only)", detect_white_margin_loop),
+        ("detect_white_margin", MasteryCards.detect_white_margin),
+        ("detect_crop_box", MasteryCards.detect_crop_box),
+    ]
+    pixels = sum(image.shape[0] * image.shape[1] for image in images)
+    print(f"{len(images)} images, {pixels / 1e6:.1f} megapixels, {mismatches} bottom edge mismatches")
+    baseline = None
+    for name, detector in detectors:
+        seconds = time_detector(detector, images, args.repeat)
+        baseline = baseline or seconds
+        print(f"{name:<24}{seconds * 1000:>9.2f} ms{baseline / seconds:>8.1f}x")
@@ -0,0 +1,183 @@
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# a local stand-in for the Groq chat completions endpoint, so the whole pipeline can run without a network
+# answers in the formats the MasteryCards prompts ask for, after a configurable delay, and can return 429s
+# (with retry-after) once a requests per minute limit is reached or 500s at random to exercise the retry path
+# point the Groq client at it with GROQ_BASE_URL=http://127.0.0.1:<port>
+
+WORD = re.compile(r"[A-Za-z][A-Za-z-]{5,}")
+SECTION_MARKER = re.compile(r"^### SECTION (\d+) ###$", re.MULTILINE)
+CAPTION_MARKER = re.compile(r"^### CAPTION (\d+) ###$", re.MULTILINE)
+
+# a few entries built from the longer words of the text, so the same text always gets the same cards
+def canned_entries(text, entries):
+    terms = []
+    for word in WORD.findall(text):
+        term = word.capitalize()
+        if term not in terms:
+            terms.append(term)
+        if len(terms) == entries:
+            break
+    return "".join(
+        f"### BEGIN ENTRY ###\nTerm: {term}\nDefinition: The meaning of {term.lower()} as it is used in this section.\n### END ENTRY ###\n"
+        for term in terms
+    )
+
+def canned_flashcard(caption):
+    words = WORD.findall(caption)
+    subject = " ".join(words[:4]).lower() or "this figure"
+    return f"Prompt: What does the figure about {subject} show?"
+
+# the answer the real model would give, worked out from the markers in the request
+def canned_answer(user_content, entries):
+    sections = SECTION_MARKER.split(user_content)
+    if len(sections) > 1:
+        return "".join(
+            f"### BEGIN SECTION {number} ###\n{canned_entries(text, entries)}### END SECTION {number} ###\n"
+            for number, text in zip(sections[1::2], sections[2::2])
+        )
+    captions = CAPTION_MARKER.split(user_content)
+    if len(captions) > 1:
+        return "".join(
+            f"### BEGIN FLASHCARD {number} ###\n{canned_flashcard(text)}\n### END FLASHCARD {number} ###\n"
+            for number, text in zip(captions[1::2], captions[2::2])
+        )
+    if user_content.startswith("Refine this caption:"):
+        return f"### BEGIN FLASHCARD ###\n{canned_flashcard(user_content)}\n### END FLASHCARD ###"
+    return canned_entries(user_content, entries)
+
+class MockSettings:
+    def __init__(self, latency=0.5, jitter=0.2, requests_per_minute=0, error_rate=0.0, entries=5):
+        self.latency = latency
+        self.jitter = jitter
+        self.requests_per_minute = requests_per_minute  # 0 for no limit
+        self.error_rate = error_rate
+        self.entries = entries
+        self.recent = deque()  # times of the requests in the last minute
+        self.counts = {"requests": 0, "rate_limited": 0, "errors": 0}
+        self.lock = threading.Lock()
+
+    # True if the request fits in the per minute limit, otherwise the seconds until it would
+    def admit(self):
+        with self.lock:
+            self.counts["requests"] += 1
+            now = time.monotonic()
+            while self.recent and now - self.recent[0] >= 60:
+                self.recent.popleft()
+            if self.requests_per_minute and len(self.recent) >= self.requests_per_minute:
+                self.counts["rate_limited"] += 1
+                return 60 - (now - self.recent[0])
+            self.recent.append(now)
+            return True
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real api
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        settings = self.server.settings
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.endswith("/chat/completions"):
+            self.send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+            return
+
+        admitted = settings.admit()
+        if admitted is not True:
+            self.send_json(429, {"error": {"message": "Rate limit reached", "type": "tokens"}}, {"retry-after": f"{admitted:.2f}"})
+            return
+        time.sleep(max(0.0, settings.latency + random.uniform(-settings.jitter, settings.jitter)))
+        if random.random() < settings.error_rate:
+            with settings.lock:
+                settings.counts["errors"] += 1
+            self.send_json(500, {"error": {"message": "Internal server error"}})
+            return
+
+        messages = request.get("messages", [])
+        user_content = messages[-1]["content"] if messages else ""
+        answer = canned_answer(user_content, settings.entries)
+        prompt_tokens = sum(len(message["content"]) for message in messages) // 4
+        completion_tokens = len(answer) // 4
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+        if request.get("stream"):
+            self.send_stream(request.get("model", "mock"), answer, usage)
+            return
+        self.send_json(200, {
+            "id": f"mock-{time.time_ns()}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "mock"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+            "usage": usage,
+        })
+
+    # server-sent events like the real api: the answer a few words at a time, the usage under x_groq on the last chunk
+    def send_stream(self, model, answer, usage):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        identifier = f"mock-{time.time_ns()}"
+        pieces = re.findall(r"\S*\s*", answer)
+        for start in range(0, len(pieces), 8):
+            self.send_event({"id": identifier, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                             "choices": [{"index": 0, "delta": {"content": "".join(pieces[start:start + 8])}, "finish_reason": None}]})
+        self.send_event({"id": identifier, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                         "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "x_groq": {"id": identifier, "usage": usage}})
+        self.send_chunk(b"data: [DONE]\n\n")
+        self.send_chunk(b"")
+
+    def send_event(self, body):
+        self.send_chunk(f"data: {json.dumps(body)}\n\n".encode("utf-8"))
+
+    def send_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+
+    def log_message(self, format, *args):
+        pass  # one line per request would drown out the benchmark output
+
+# starts the server on a background thread, port 0 picks a free port; returns the server (server.server_port)
+def start_server(settings=None, host="127.0.0.1", port=0):
+    server = ThreadingHTTPServer((host, port), MockHandler)
+    server.daemon_threads = True
+    server.settings = settings or MockSettings()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def add_settings_arguments(parser):
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds the mock takes per request")
+    parser.add_argument("--jitter", type=float, default=0.2, help="random +/- seconds added to the latency")
+    parser.add_argument("--server-rpm", type=int, default=0, help="requests per minute before the mock answers 429 (0 for no limit)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with a 500")
+    parser.add_argument("--entries", type=int, default=5, help="flashcard entries in each canned answer")
+
+def settings_from_arguments(args):
+    return MockSettings(args.latency, args.jitter, args.server_rpm, args.error_rate, args.entries)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve canned chat completions for running MasteryCards offline.")
+    parser.add_argument("--port", type=int, default=8765)
+    add_settings_arguments(parser)
+    args = parser.parse_args()
+    server = start_server(settings_from_arguments(args), port=args.port)
+    print(f"Mock LLM listening, run MasteryCards with GROQ_BASE_URL=http://127.0.0.1:{server.server_port}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        print(server.settings.counts)
@@ -0,0 +1,170 @@
+import os
+import re
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+
+# scores generated decks offline against a reference topic list, the automated version of the
+# flashcard_topics.pdf checklist: topic coverage, duplicate rate, placeholder / "Error in LLM response" rate
+# and definition length, for several decks at once so prompt, model and chunk size configurations can be compared
+# cards and topics are compared as hashed character trigram vectors, so a few thousand cards take well under a second
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+from MasteryCards import read_deck_rows, CardStore, PLACEHOLDER, CARD_STORE_SUFFIX
+
+TOPICS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "probability_topics.txt")
+TRIGRAM_BUCKETS = 2048  # length of the hashed trigram vectors
+TOPIC_MATCH = 0.75  # share of a topic's trigrams a card front has to contain to cover the topic
+DUPLICATE_SIMILARITY = 0.9  # cosine similarity of two fronts above which the later card is counted as a repeat
+DUPLICATE_BLOCK = 2048  # cards compared at a time when looking for repeats, bounds the size of the similarity matrix
+SHORT_DEFINITION = 5  # words, definitions shorter than this can't explain much
+LONG_DEFINITION = 80  # words, definitions longer than this are too long to review
+ERROR_TEXT = "Error in LLM response"
+NON_WORD = re.compile(r"[^0-9a-z]+")
+
+# lowercase words separated by single spaces, with a space either side so the first and last letters get trigrams
+def normalize(text):
+    return " " + NON_WORD.sub(" ", text.lower()).strip() + " "
+
+# one row per text with a 1 in the bucket of each trigram it contains, built for all texts in one go:
+# the texts are joined by newlines (normalize() leaves none in them) and every trigram without one is hashed
+def trigram_vectors(texts, buckets=TRIGRAM_BUCKETS):
+    vectors = np.zeros((len(texts), buckets), dtype=np.float32)
+    if not texts:
+        return vectors
+    codes = np.frombuffer("\n".join(normalize(text) for text in texts).encode("utf-8"), dtype=np.uint8).astype(np.uint32)
+    newline = codes == 10
+    rows = np.cumsum(newline)[:-2]  # text each trigram starts in
+    valid = ~(newline[:-2] | newline[1:-1] | newline[2:])
+    grams = (codes[:-2] << 16) | (codes[1:-1] << 8) | codes[2:]
+    hashed = (grams.astype(np.uint64) * 2654435761) & 0xFFFFFFFF  # multiplicative hash, spreads similar trigrams apart
+    vectors[rows[valid], (hashed[valid] % buckets).astype(np.intp)] = 1.0
+    return vectors
+
+# one line per topic, blank lines and # comments skipped
+def read_topics(path):
+    with open(path, encoding="utf-8") as topics_file:
+        return [line.strip() for line in topics_file if line.strip() and not line.startswith("#")]
+
+# (front, back) of every row of a TSV deck or every card of a <deck>.cards.sqlite CardStore
+# repeated cards are kept, one entry per row, so they count towards the duplicate rate
+def read_cards(path):
+    if path.endswith(CARD_STORE_SUFFIX):
+        return list(CardStore.load(path))
+    with open(path, encoding="utf-8", newline="") as tsv_file:
+        _, rows = read_deck_rows(tsv_file)
+        return [(front, back) for _, front, back, _ in rows]
+
+# for each topic, whether some card front contains at least TOPIC_MATCH of its trigrams
+def topic_coverage(topic_vectors, front_vectors):
+    if not len(front_vectors):
+        return np.zeros(len(topic_vectors), dtype=bool)
+    shared = topic_vectors @ front_vectors.T
+    sizes = np.maximum(topic_vectors.sum(axis=1, keepdims=True), 1.0)
+    return (shared / sizes >= TOPIC_MATCH).any(axis=1)
+
+# for each card, whether its front is nearly the same as the front of a card before it
+# the similarities are worked out DUPLICATE_BLOCK rows at a time against all earlier cards
+def duplicate_flags(front_vectors):
+    count = len(front_vectors)
+    unit = front_vectors / np.maximum(np.linalg.norm(front_vectors, axis=1, keepdims=True), 1e-9)
+    flags = np.zeros(count, dtype=bool)
+    for start in range(0, count, DUPLICATE_BLOCK):
+        stop = min(start + DUPLICATE_BLOCK, count)
+        similarity = unit[start:stop] @ unit[:stop].T
+        earlier = np.arange(stop)[None, :] < np.arange(start, stop)[:, None]
+        flags[start:stop] = ((similarity >= DUPLICATE_SIMILARITY) & earlier).any(axis=1)
+    return flags
+
+# all the scores of one deck, topic_vectors are the trigram vectors of topics
+def evaluate_deck(path, topics, topic_vectors):
+    start = time.perf_counter()
+    cards = read_cards(path)
+    fronts = [front for front, _ in cards]
+    backs = [back for _, back in cards]
+    figure = np.array(["<img" in back for back in backs], dtype=bool)
+    placeholder = np.array(
+        [ERROR_TEXT in front or bool(PLACEHOLDER.fullmatch(front)) or bool(PLACEHOLDER.fullmatch(back)) for front, back in cards],
+        dtype=bool,
+    )
+    front_vectors = trigram_vectors(fronts)
+    covered = topic_coverage(topic_vectors, front_vectors)
+    duplicates = duplicate_flags(front_vectors)
+    words = np.array([len(back.split()) for back, is_figure in zip(backs, figure) if not is_figure], dtype=np.int64)
+
+    result = {
+        "deck": path,
+        "cards": len(cards),
+        "figure_cards": int(figure.sum()),
+        "coverage": float(covered.mean()) if len(topics) else 0.0,
+        "missing_topics": [topic for topic, hit in zip(topics, covered) if not hit],
+        "duplicate_rate": float(duplicates.mean()) if len(cards) else 0.0,
+        "placeholder_rate": float(placeholder.mean()) if len(cards) else 0.0,
+        "definition_words": {
+            "mean": float(words.mean()) if len(words) else 0.0,
+            "median": float(np.median(words)) if len(words) else 0.0,
+            "short": float((words < SHORT_DEFINITION).mean()) if len(words) else 0.0,
+            "long": float((words > LONG_DEFINITION).mean()) if len(words) else 0.0,
+        },
+        "llm_calls": llm_calls(path),
+    }
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+# LLM requests sent to make the deck, if its run wrote a trace next to it (--trace <deck name>.trace.json)
+def llm_calls(deck_path):
+    deck_path = deck_path[:-len(CARD_STORE_SUFFIX)] if deck_path.endswith(CARD_STORE_SUFFIX) else os.path.splitext(deck_path)[0]
+    trace_path = deck_path + ".trace.json"
+    if not os.path.exists(trace_path):
+        return None
+    with open(trace_path, encoding="utf-8") as trace_file:
+        return json.load(trace_file)["summary"]["llm"]["sent"]
+
+# the configuration name and deck path of a "name=deck.tsv" argument, a plain path is named after its file
+def parse_deck_argument(argument):
+    name, separator, path = argument.partition("=")
+    if not separator:
+        path = argument
+        name = os.path.splitext(os.path.basename(argument))[0]
+    return name, path
+
+def report(results):
+    print(f"{'configuration':<24}{'cards':>7}{'figures':>8}{'coverage':>10}{'repeats':>9}{'errors':>8}"
+          f"{'words':>7}{'short':>7}{'long':>7}{'calls':>7}{'cards/call':>11}")
+    for name, result in results.items():
+        words = result["definition_words"]
+        calls = result["llm_calls"]
+        print(
+            f"{name:<24}{result['cards']:>7}{result['figure_cards']:>8}{result['coverage']:>10.0%}"
+            f"{result['duplicate_rate']:>9.1%}{result['placeholder_rate']:>8.1%}"
+            f"{words['median']:>7.0f}{words['short']:>7.1%}{words['long']:>7.1%}"
+            f"{calls if calls is not None else '-':>7}{result['cards'] / calls if calls else 0:>11.2f}"
+        )
+    for name, result in results.items():
+        if result["missing_topics"]:
+            print(f"{name} misses: {', '.join(result['missing_topics'])}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score generated decks against a reference topic list and compare them.")
+    parser.add_argument("decks", nargs="+", help="TSV decks or <deck>.cards.sqlite files, name=path to name the configuration")
+    parser.add_argument("--topics", default=TOPICS_FILE, help="reference topics, one per line (default the 20 probability topics)")
+    parser.add_argument("--json", help="also write the scores to this file")
+    args = parser.parse_args()
+
+    topics = read_topics(args.topics)
+    topic_vectors = trigram_vectors(topics)
+    results = {}
+    for argument in args.decks:
+        name, path = parse_deck_argument(argument)
+        if not os.path.exists(path):
+            parser.error(f"deck '{path}' not found")
+        results[name] = evaluate_deck(path, topics, topic_vectors)
+    report(results)
+    print(f"scored {sum(result['cards'] for result in results.values())} cards in {sum(result['seconds'] for result in results.values()):.2f}s")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as json_file:
+            json.dump(results, json_file, indent=2)
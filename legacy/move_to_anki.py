@@ -15,7 +15,7 @@ def get_anki_media_folder():
         raise Exception("Unsupported operating system.")
 
 def move_images_to_anki(source_folder):
-    """Move PNG images from the source folder to Anki's media folder."""
+    """Move PNG and WebP images from the source folder to Anki's media folder."""
     anki_media_folder = get_anki_media_folder()
     if not os.path.exists(anki_media_folder):
         raise FileNotFoundError(f"Anki media folder not found at {anki_media_folder}")
@@ -24,11 +24,15 @@ def move_images_to_anki(source_folder):
     if not os.path.exists(source_folder):
         raise FileNotFoundError(f"Source folder not found at {source_folder}")
     
-    # Move PNG files to Anki's media folder
+    # Move PNG and WebP files to Anki's media folder
     for filename in os.listdir(source_folder):
-        if filename.endswith(".png"):
+        if filename.endswith((".png", ".webp")):
             source_path = os.path.join(source_folder, filename)
             destination_path = os.path.join(anki_media_folder, filename)
+            if filename.startswith("fig_") and os.path.exists(destination_path):
+                # images are named after a hash of their pixels, so one with the same name is already there
+                os.remove(source_path)
+                continue
             shutil.move(source_path, destination_path)
             print(f"Moved: {filename} to {anki_media_folder}")
 